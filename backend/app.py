@@ -1,3 +1,4 @@
+import asyncio
 import json
 import uvicorn
 from pathlib import Path
@@ -16,12 +17,15 @@ from storage import (
     update_config,
 )
 from tasks import TaskState, tasks
-from vk_service import VKService
+from vk_service import clients
 from database import (
     get_all_tasks, get_task as get_task_db, get_group_info,
-    save_group_info, get_campaign_stats
+    save_group_info, get_campaign_stats, get_task_logs, get_task_log_tail,
+    db_read, db_write, shutdown_db
 )
 from watchers import watchers
+from cache import response_cache
+from retention import retention_report, run_retention, run_retention_loop
 
 app = FastAPI(title="VK Admin Panel", version="1.0.0")
 
@@ -34,11 +38,46 @@ templates = Jinja2Templates(directory=str(TEMPLATES_DIR))
 app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
 
 
+@app.on_event("startup")
+async def resume_watchers() -> None:
+    """Продолжает автоответы, работавшие до перезапуска."""
+    await watchers.resume(load_config())
+
+
+@app.on_event("startup")
+async def start_stats_reconcile() -> None:
+    """Периодически сверяет счётчики рассылок с историей."""
+    interval = load_config().stats_reconcile_hours
+    if interval:
+        asyncio.create_task(tasks.run_reconcile(interval))
+
+
+@app.on_event("startup")
+async def start_retention() -> None:
+    """Периодически сворачивает и удаляет старую историю в bot.db."""
+    interval = load_config().retention_interval_hours
+    if interval:
+        asyncio.create_task(run_retention_loop(interval))
+
+
+@app.on_event("shutdown")
+async def close_clients() -> None:
+    """
+    Сохраняет курсоры автоответов и буферы идущих рассылок, закрывает HTTP-сессии
+    пула VK-клиентов и базу.
+    """
+    watchers.checkpoint()
+    tasks.flush()
+    await clients.close_all()
+    shutdown_db()
+
+
 class CommunityPayload(BaseModel):
     name: str | None = ""
     group_id: int
     user_token: str
     group_token: str
+    send_concurrency: int = Field(5, ge=1, le=20)
 
 
 class ConfigPayload(BaseModel):
@@ -57,6 +96,9 @@ class ConfigPayload(BaseModel):
 class SendPayload(BaseModel):
     post_ids: list[int]
     message: str | None = None
+    streaming: bool | None = None
+    # Не отвечать тем, кому под этим постом уже отвечали прошлые рассылки
+    only_new: bool = False
 
     @validator("post_ids")
     def validate_posts(cls, v: list[int]) -> list[int]:
@@ -146,17 +188,20 @@ async def set_active_group(payload: ActiveGroupPayload):
 
 
 @app.get("/api/posts")
-async def get_posts(limit: int = 100):
+async def get_posts(limit: int = 100, cursor: str | None = None, since_id: int | None = None):
     cfg = load_config()
     if not get_active_community(cfg):
         raise HTTPException(status_code=400, detail="Не выбрано сообщество")
-    client = VKService(cfg)
     safe_limit = max(1, min(limit, 100))
     try:
-        posts = await client.fetch_posts(limit=safe_limit)
+        async with clients.lease(cfg) as client:
+            if since_id is not None:
+                # Инкрементальное обновление: только посты новее since_id
+                posts = await client.fetch_new_posts(since_id)
+                return {"items": posts, "next_cursor": None}
+            return await client.fetch_posts_page(limit=safe_limit, cursor=cursor)
     except Exception as exc:
         raise HTTPException(status_code=400, detail=str(exc)) from exc
-    return {"items": posts}
 
 
 @app.post("/api/send")
@@ -177,15 +222,18 @@ async def start_campaign(payload: SendPayload):
         cfg = copy_fn(update={"promo_message": promo_message})
         save_config(cfg)
 
-    state: TaskState = tasks.create_campaign(cfg, payload.post_ids, promo_message)
+    state: TaskState = tasks.create_campaign(
+        cfg, payload.post_ids, promo_message,
+        streaming=payload.streaming, only_new=payload.only_new
+    )
     return {"task_id": state.id, "status": state.status}
 
 
 @app.get("/api/tasks")
 async def list_tasks(limit: int = 50, offset: int = 0):
     # Получаем задачи из памяти и из БД
-    memory_tasks = {task.id: task.snapshot() for task in tasks.tasks.values()}
-    db_tasks = get_all_tasks(limit=limit, offset=offset)
+    memory_tasks = {task.id: task.snapshot(with_log=False) for task in tasks.tasks.values()}
+    db_tasks = await db_read(get_all_tasks, limit=limit, offset=offset)
     
     # Объединяем, приоритет у задач в памяти (активные)
     result = []
@@ -205,7 +253,6 @@ async def list_tasks(limit: int = 50, offset: int = 0):
                 "sent": db_task.get("sent", 0),
                 "failed": db_task.get("failed", 0),
                 "total": db_task.get("total", 0),
-                "log": json.loads(db_task.get("log", "[]")),
                 "created_at": db_task.get("created_at"),
             })
     
@@ -220,11 +267,14 @@ async def get_task(task_id: str):
         return state.snapshot()
     
     # Если нет в памяти, ищем в БД
-    db_task = get_task_db(task_id)
+    db_task = await db_read(get_task_db, task_id)
     if not db_task:
         raise HTTPException(status_code=404, detail="Task not found")
     
-    import json
+    # Хвост журнала из task_logs; у старых задач журнал лежит JSON в tasks.log
+    log = await db_read(get_task_log_tail, task_id)
+    if not log:
+        log = json.loads(db_task.get("log") or "[]")
     return {
         "id": db_task["id"],
         "status": db_task["status"],
@@ -234,11 +284,35 @@ async def get_task(task_id: str):
         "sent": db_task.get("sent", 0),
         "failed": db_task.get("failed", 0),
         "total": db_task.get("total", 0),
-        "log": json.loads(db_task.get("log", "[]")),
+        "log": log,
         "created_at": db_task.get("created_at"),
     }
 
 
+@app.get("/api/tasks/{task_id}/logs")
+async def get_task_logs_api(task_id: str, after: int = 0, limit: int = 200):
+    """Журнал задачи страницами: строки с seq больше after."""
+    limit = max(1, min(limit, 1000))
+    state = tasks.get(task_id)
+    if state:
+        # Запрошенное ещё в кольцевом буфере — отдаём из памяти без базы
+        first_seq = state.log_seq - len(state.log) + 1
+        if after + 1 >= first_seq:
+            lines = list(state.log)[after + 1 - first_seq:][:limit]
+            items = [{"seq": after + 1 + i, "message": line} for i, line in enumerate(lines)]
+            return {"items": items, "next_after": items[-1]["seq"] if items else after}
+        if state.log_writer is not None:
+            pending = state.log_writer.flush()
+            if pending is not None:
+                await asyncio.wrap_future(pending)
+    elif not await db_read(get_task_db, task_id):
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    rows = await db_read(get_task_logs, task_id, after=after, limit=limit)
+    items = [{"seq": row["seq"], "message": row["message"]} for row in rows]
+    return {"items": items, "next_after": items[-1]["seq"] if items else after}
+
+
 @app.get("/api/group/info")
 async def get_group_info_api():
     """Получает информацию о группе."""
@@ -248,7 +322,7 @@ async def get_group_info_api():
         raise HTTPException(status_code=400, detail="Токены не настроены")
     
     # Проверяем кэш в БД
-    cached_info = get_group_info(active.group_id)
+    cached_info = await db_read(get_group_info, active.group_id)
     
     # Если кэш свежий (менее часа), возвращаем его
     if cached_info:
@@ -259,10 +333,10 @@ async def get_group_info_api():
     
     # Получаем свежую информацию из VK API
     try:
-        client = VKService(cfg)
-        group_data = await client.get_group_info()
+        async with clients.lease(cfg) as client:
+            group_data = await client.get_group_info()
         if group_data:
-            save_group_info(active.group_id, group_data)
+            await db_write(save_group_info, active.group_id, group_data)
             return group_data
         else:
             return cached_info or {}
@@ -282,8 +356,8 @@ async def get_post_details_api(post_id: int):
         raise HTTPException(status_code=400, detail="Токены не настроены")
     
     try:
-        client = VKService(cfg)
-        post_details = await client.get_post_details(post_id)
+        async with clients.lease(cfg) as client:
+            post_details = await client.get_post_details(post_id)
         return post_details
     except Exception as exc:
         raise HTTPException(status_code=400, detail=str(exc)) from exc
@@ -292,10 +366,37 @@ async def get_post_details_api(post_id: int):
 @app.get("/api/stats/campaign/{task_id}")
 async def get_campaign_stats_api(task_id: str):
     """Получает детальную статистику по кампании."""
-    stats = get_campaign_stats(task_id)
+    stats = await db_read(get_campaign_stats, task_id)
     return stats
 
 
+@app.post("/api/stats/reconcile")
+async def reconcile_stats_api():
+    """Сверяет счётчики рассылок с историей сейчас, не дожидаясь фоновой сверки."""
+    return {"fixed": await tasks.reconcile_stats()}
+
+
+@app.get("/api/maintenance/retention")
+async def retention_report_api():
+    """Пробный прогон очистки: сколько строк и места она освободит."""
+    return await retention_report(load_config())
+
+
+@app.post("/api/maintenance/retention")
+async def run_retention_api(convert_vacuum: bool = False):
+    """
+    Запускает очистку истории сейчас. convert_vacuum=true — заодно перевести
+    старую базу на инкрементальную очистку (разовый полный VACUUM).
+    """
+    return await run_retention(load_config(), convert_vacuum=convert_vacuum)
+
+
+@app.get("/api/stats/cache")
+async def get_cache_stats_api():
+    """Счётчики кэша ответов VK API."""
+    return response_cache.stats()
+
+
 class WatchPayload(BaseModel):
     post_id: int
     message: str
@@ -0,0 +1,215 @@
+"""
+Микробенчмарки горячих путей бэкенда. Запуск из папки backend:
+
+    python bench.py comments    # разбор страницы wall.getComments
+    python bench.py db          # запись campaign_history: по одной и пачками
+    python bench.py looplag     # задержка цикла событий при записи рассылки в базу
+"""
+import argparse
+import json
+import random
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+
+def _comments_page(count: int = 100) -> bytes:
+    """Синтетическая страница wall.getComments, похожая на реальный ответ VK."""
+    rnd = random.Random(42)
+    items = []
+    for i in range(count):
+        items.append(
+            {
+                "id": 100000 + i,
+                "from_id": rnd.randint(1, 800_000_000),
+                "date": 1_700_000_000 + i,
+                "text": "Участвую в розыгрыше! " * rnd.randint(1, 4),
+                "post_id": 1234,
+                "owner_id": -223693021,
+                "parents_stack": [],
+                "likes": {"can_like": 1, "count": rnd.randint(0, 50), "user_likes": 0},
+                "thread": {"count": 0, "items": [], "can_post": True, "show_reply_button": True},
+            }
+        )
+    body = {"response": {"count": 40000, "current_level_count": 40000, "items": items}}
+    return json.dumps(body, ensure_ascii=False).encode("utf-8")
+
+
+def _old_comments_path(body: bytes) -> List[Dict[str, object]]:
+    # Как раньше: текст -> json модуля vkbottle -> debug-лог ответа -> пересборка dict
+    from vkbottle.modules import json as vk_json
+
+    text = body.decode("utf-8")
+    resp = vk_json.loads(text)
+    str(resp)  # vkbottle форматирует весь ответ в logger.debug
+    payload = resp.get("response", resp) if isinstance(resp, dict) else {}
+    items = payload.get("items") if isinstance(payload, dict) else []
+    return [{"id": c.get("id"), "from_id": c.get("from_id")} for c in items or []]
+
+
+def _fast_comments_path(body: bytes) -> List[Tuple[int, int]]:
+    from ratelimit import json_loads
+
+    payload = json_loads(body).get("response")
+    return [(c.get("from_id"), c.get("id")) for c in payload.get("items") or []]
+
+
+def _measure(fn: Callable[[bytes], object], body: bytes, rounds: int) -> Tuple[float, float]:
+    fn(body)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn(body)
+    per_call = (time.perf_counter() - started) / rounds
+
+    tracemalloc.start()
+    fn(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return per_call, peak
+
+
+def bench_comments(rounds: int) -> None:
+    body = _comments_page()
+    print(f"Страница: 100 комментариев, {len(body) / 1024:.1f} КБ")
+    for name, fn in (("vkbottle request", _old_comments_path), ("request_fast", _fast_comments_path)):
+        per_call, peak = _measure(fn, body, rounds)
+        print(f"{name:>18}: {per_call * 1e6:8.1f} мкс/страница, пик памяти {peak / 1024:7.1f} КБ")
+
+
+def _old_campaign_entry(db_path: Path, row: Tuple[Any, ...]) -> None:
+    # Как раньше: новое соединение, журнал отката по умолчанию, commit и close на запись
+    conn = sqlite3.connect(str(db_path))
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.execute(
+            "INSERT INTO campaign_history (task_id, user_id, post_id, comment_id, status, sent_at, error) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            row,
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def bench_db(rounds: int) -> None:
+    import database
+
+    rows = [("bench", 1000 + i, 1234, 50000 + i, "sent", "2024-01-01T00:00:00", None) for i in range(rounds)]
+    with tempfile.TemporaryDirectory() as tmp:
+        old_path = Path(tmp) / "old.db"
+        conn = sqlite3.connect(str(old_path))
+        conn.execute(
+            "CREATE TABLE campaign_history (id INTEGER PRIMARY KEY AUTOINCREMENT, task_id TEXT NOT NULL, "
+            "user_id INTEGER NOT NULL, post_id INTEGER NOT NULL, comment_id INTEGER NOT NULL, "
+            "status TEXT NOT NULL, sent_at TEXT, error TEXT)"
+        )
+        conn.close()
+        started = time.perf_counter()
+        for row in rows:
+            _old_campaign_entry(old_path, row)
+        old_rate = rounds / (time.perf_counter() - started)
+
+        database.DB_PATH = Path(tmp) / "new.db"
+        database.init_db()
+        started = time.perf_counter()
+        for task_id, user_id, post_id, comment_id, status, _, error in rows:
+            database.save_campaign_entry(task_id, user_id, post_id, comment_id, status, error)
+        new_rate = rounds / (time.perf_counter() - started)
+
+        history = database.CampaignHistoryWriter("bench")
+        started = time.perf_counter()
+        for _, user_id, post_id, comment_id, status, _, error in rows:
+            history.add(user_id, post_id, comment_id, status, error)
+        history.flush()
+        # Очередь потока записи выполняется по порядку: close_db дождётся пачек
+        database.db_write_nowait(database.close_db).result()
+        batch_rate = rounds / (time.perf_counter() - started)
+        database.close_db()
+
+    print(f"{rounds} записей campaign_history")
+    print(f"{'соединение на вызов':>22}: {old_rate:9.0f} записей/с")
+    print(f"{'общее соединение, WAL':>22}: {new_rate:9.0f} записей/с")
+    print(f"{'пачки по ' + str(database.HISTORY_FLUSH_SIZE):>22}: {batch_rate:9.0f} записей/с")
+
+
+def _percentile(values: List[float], share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+def bench_loop_lag(rounds: int) -> None:
+    """
+    Задержка цикла событий во время записи истории рассылки: пробник спит по
+    5 мс и меряет, насколько позже просыпается, пока "рассылка" пишет в базу
+    по записи на ответ — прямо в цикле или через поток записи.
+    """
+    import asyncio
+
+    import database
+
+    tick = 0.005
+
+    async def probe(stop: asyncio.Event, lags: List[float]) -> None:
+        while not stop.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(tick)
+            lags.append(time.perf_counter() - started - tick)
+
+    def write_inline(i: int, log: List[str]) -> None:
+        database.save_campaign_entry("bench", 1000 + i, 1234, 50000 + i, "sent")
+        database.update_task_status("bench", "sending", sent=i, log=log)
+
+    def write_offloaded(i: int, log: List[str]) -> None:
+        database.db_write_nowait(database.save_campaign_entry, "bench", 1000 + i, 1234, 50000 + i, "sent")
+        database.db_write_nowait(database.update_task_status, "bench", "sending", sent=i, log=log)
+
+    async def run(write: Callable[[int, List[str]], None]) -> Tuple[List[float], float]:
+        stop = asyncio.Event()
+        lags: List[float] = []
+        prober = asyncio.create_task(probe(stop, lags))
+        log = [f"Ответил пользователю {i}" for i in range(80)]
+        started = time.perf_counter()
+        for i in range(rounds):
+            write(i, log)
+            if i % 10 == 0:
+                await asyncio.sleep(0)
+        await asyncio.wrap_future(database.db_write_nowait(lambda: None))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await prober
+        return lags, elapsed
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_PATH = Path(tmp) / "lag.db"
+        database.init_db()
+        database.save_task({"id": "bench", "status": "sending", "promo_message": "bench"})
+        print(f"{rounds} ответов: запись истории + обновление задачи на каждый")
+        for name, write in (("в цикле событий", write_inline), ("поток записи", write_offloaded)):
+            lags, elapsed = asyncio.run(run(write))
+            print(
+                f"{name:>16}: {elapsed:5.2f} с, задержка цикла p50 {_percentile(lags, 0.5) * 1e3:6.2f} мс, "
+                f"p99 {_percentile(lags, 0.99) * 1e3:6.2f} мс, max {max(lags) * 1e3:7.2f} мс"
+            )
+        database.shutdown_db()
+        database.close_db()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("bench", choices=["comments", "db", "looplag"])
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    if args.bench == "comments":
+        bench_comments(args.rounds)
+    elif args.bench == "db":
+        bench_db(args.rounds)
+    elif args.bench == "looplag":
+        bench_loop_lag(args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -40,7 +40,10 @@ async def send_promos_to_all():
 
     client = VKService(cfg)
     print("[*] Старт рассылки...")
-    await client.send_campaign(post_ids=post_ids, message=cfg.promo_message, on_progress=console_progress)
+    try:
+        await client.send_campaign(post_ids=post_ids, message=cfg.promo_message, on_progress=console_progress)
+    finally:
+        await client.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,107 @@
+"""
+In-process кэш ответов VK API с TTL по методу и LRU-вытеснением.
+
+Ключ — (сообщество, метод, параметры). Кэшируются только чтения, которые
+интерфейс запрашивает повторно (список постов, детали поста); после записи
+в VK (ответы рассылки, автоответы) записи сообщества сбрасываются явно.
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+CacheParams = Tuple[Tuple[str, Any], ...]
+CacheKey = Tuple[int, str, CacheParams]
+
+# Сколько секунд живёт ответ каждого метода
+DEFAULT_TTLS: Dict[str, float] = {
+    "wall.get": 60.0,
+    "wall.getById": 120.0,
+}
+DEFAULT_TTL = 30.0
+DEFAULT_MAXSIZE = 512
+
+
+def make_params(**params: Any) -> CacheParams:
+    return tuple(sorted(params.items()))
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        maxsize: int = DEFAULT_MAXSIZE,
+        ttls: Optional[Dict[str, float]] = None,
+        default_ttl: float = DEFAULT_TTL,
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttls = dict(DEFAULT_TTLS if ttls is None else ttls)
+        self.default_ttl = default_ttl
+        self._entries: "OrderedDict[CacheKey, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, community: int, method: str, params: CacheParams) -> Optional[Any]:
+        key = (community, method, params)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, community: int, method: str, params: CacheParams, value: Any) -> None:
+        key = (community, method, params)
+        ttl = self.ttls.get(method, self.default_ttl)
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(
+        self, community: int, method: Optional[str] = None, post_id: Optional[int] = None
+    ) -> int:
+        """
+        Сбрасывает записи сообщества. С method — только этого метода, с post_id —
+        записи этого поста и все выборки без конкретного поста (например, wall.get).
+        """
+        dropped = 0
+        for key in list(self._entries):
+            key_community, key_method, params = key
+            if key_community != community:
+                continue
+            if method is not None and key_method != method:
+                continue
+            if post_id is not None:
+                key_post = dict(params).get("post_id")
+                if key_post is not None and key_post != post_id:
+                    continue
+            del self._entries[key]
+            dropped += 1
+        self.invalidations += dropped
+        return dropped
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+response_cache = ResponseCache()
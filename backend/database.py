@@ -1,13 +1,22 @@
 """
 База данных SQLite для хранения задач, статистики и истории рассылок.
 """
+import asyncio
+import logging
 import sqlite3
 import json
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 from datetime import datetime
-from typing import Dict, List, Optional, Any
+from typing import Callable, Dict, List, Optional, Any, Set, Tuple, TypeVar
 from contextlib import contextmanager
 
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
 DB_PATH = Path(__file__).parent.parent / "data" / "bot.db"
 
 
@@ -18,20 +27,244 @@ def get_db_path() -> Path:
     return db_path
 
 
+# Сколько подготовленных запросов держит в кэше каждое соединение
+STATEMENT_CACHE_SIZE = 256
+# Сколько миллисекунд ждать снятия блокировки записи, прежде чем упасть
+BUSY_TIMEOUT_MS = 5000
+
+_local = threading.local()
+
+
+def _connect(db_path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(str(db_path), cached_statements=STATEMENT_CACHE_SIZE)
+    conn.row_factory = sqlite3.Row
+    # Действует только на новую базу (до перехода в WAL); существующую
+    # переводит явный запуск очистки, см. enable_incremental_vacuum
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    # WAL: чтение (/api/tasks) не ждёт записи рассылки и наоборот;
+    # NORMAL в WAL не теряет согласованность, только последние транзакции при сбое питания
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    return conn
+
+
+def get_connection() -> sqlite3.Connection:
+    """Соединение текущего потока: открывается один раз и дальше переиспользуется."""
+    db_path = get_db_path()
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "path", None) != db_path:
+        if conn is not None:
+            conn.close()
+        conn = _connect(db_path)
+        _local.conn = conn
+        _local.path = db_path
+    return conn
+
+
+def close_db() -> None:
+    """Закрывает соединение текущего потока (при остановке приложения)."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+# Вся работа с базой идёт вне цикла событий: записи — одним потоком по очереди
+# (порядок сохраняется, блокировка записи не делится), чтения — небольшим пулом,
+# которому WAL позволяет не ждать запись
+DB_READERS = 2
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+_readers = ThreadPoolExecutor(max_workers=DB_READERS, thread_name_prefix="db-reader")
+# После shutdown_db записи выполняются сразу в вызывающем потоке: задачи,
+# которые сервер отменяет уже после остановки базы, дописывают свои буферы
+_closed = False
+
+
+async def db_read(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Выполняет читающую функцию этого модуля в пуле чтения и ждёт результат."""
+    if _closed:
+        return fn(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_readers, partial(fn, *args, **kwargs))
+
+
+async def db_write(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Ставит запись в очередь потока записи и ждёт, пока она попадёт в базу."""
+    return await asyncio.wrap_future(db_write_nowait(fn, *args, **kwargs))
+
+
+def db_write_nowait(fn: Callable[..., T], *args: Any, **kwargs: Any) -> "Future[T]":
+    """
+    Ставит запись в очередь потока записи, не дожидаясь её. Для синхронных
+    обработчиков внутри цикла событий (прогресс рассылки, таймеры); ошибки пишутся в лог.
+    """
+    if _closed:
+        future: "Future[T]" = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as exc:
+            future.set_exception(exc)
+    else:
+        future = _writer.submit(fn, *args, **kwargs)
+    future.add_done_callback(_log_write_error)
+    return future
+
+
+def _log_write_error(future: "Future[Any]") -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Ошибка записи в базу", exc_info=future.exception())
+
+
+def shutdown_db() -> None:
+    """Дожидается очереди записи и закрывает соединение потока записи."""
+    global _closed
+    if _closed:
+        return
+    _writer.submit(close_db).result()
+    _writer.shutdown(wait=True)
+    _readers.shutdown(wait=True)
+    _closed = True
+
+
 @contextmanager
 def get_db():
-    """Контекстный менеджер для работы с базой данных."""
-    db_path = get_db_path()
-    conn = sqlite3.connect(str(db_path))
-    conn.row_factory = sqlite3.Row
+    """Контекстный менеджер для работы с базой данных: одна транзакция на блок."""
+    conn = get_connection()
     try:
         yield conn
         conn.commit()
     except Exception:
         conn.rollback()
         raise
-    finally:
-        conn.close()
+
+
+# Пороги сброса буферов записи: по числу строк и по времени
+HISTORY_FLUSH_SIZE = 200
+HISTORY_FLUSH_INTERVAL = 1.0
+# Сколько раз пачка возвращается в буфер после неудачной записи, прежде чем её бросить
+HISTORY_FLUSH_RETRIES = 3
+
+
+class BatchWriter:
+    """
+    Буфер строк одной таблицы. Строки уходят в базу пачкой (executemany в одной
+    транзакции в потоке записи), когда их набралось flush_size или с первой
+    несохранённой прошло flush_interval секунд, и при flush() в конце работы.
+    Пачка, которую не удалось записать, возвращается в начало буфера и уходит
+    со следующим сбросом (до HISTORY_FLUSH_RETRIES раз подряд). При падении
+    процесса теряется не больше одного окна и очереди записи.
+    """
+
+    def __init__(
+        self,
+        save: Callable[[List[Tuple[Any, ...]]], None],
+        flush_size: int = HISTORY_FLUSH_SIZE,
+        flush_interval: float = HISTORY_FLUSH_INTERVAL,
+    ) -> None:
+        self.save = save
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self._pending: List[Tuple[Any, ...]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._failures = 0
+
+    def add_row(self, row: Tuple[Any, ...]) -> None:
+        self._pending.append(row)
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+        else:
+            self._schedule()
+
+    def _schedule(self) -> None:
+        if self._timer is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # вне цикла событий сбросится по размеру или явным flush()
+        self._timer = loop.call_later(self.flush_interval, self.flush)
+
+    def flush(self) -> Optional["Future[None]"]:
+        """Отдаёт накопленную пачку потоку записи; возвращает её Future."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return None
+        rows = self._pending
+        self._pending = []
+        self.written += len(rows)
+        future = db_write_nowait(self.save, rows)
+        try:
+            loop: Optional[asyncio.AbstractEventLoop] = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        future.add_done_callback(lambda f: self._on_written(f, rows, loop))
+        return future
+
+    def _on_written(
+        self,
+        future: "Future[None]",
+        rows: List[Tuple[Any, ...]],
+        loop: Optional[asyncio.AbstractEventLoop],
+    ) -> None:
+        # Вызывается в потоке записи: буфер трогаем только из цикла событий
+        if loop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self._settle, future, rows)
+            except RuntimeError:
+                pass  # цикл уже закрыт — пачку некуда вернуть
+            return
+        self._settle(future, rows)
+
+    def _settle(self, future: "Future[None]", rows: List[Tuple[Any, ...]]) -> None:
+        if future.cancelled() or future.exception() is None:
+            self._failures = 0
+            return
+        self.written -= len(rows)
+        self._failures += 1
+        if self._failures > HISTORY_FLUSH_RETRIES:
+            self._failures = 0
+            logger.error("Пачка из %s строк не записана после повторов и отброшена", len(rows))
+            return
+        self._pending[:0] = rows
+        self._schedule()
+
+
+def _single_group_id() -> Optional[int]:
+    """Сообщество из настроек, если оно там одно (для разбора старой истории без group_id)."""
+    # Локальный импорт: настройки базе нужны только при первом построении reply_ledger
+    from storage import load_config
+
+    group_ids = {community.group_id for community in load_config().communities}
+    return group_ids.pop() if len(group_ids) == 1 else None
+
+
+def _recount_queries(where: str) -> Dict[str, str]:
+    """SELECT-ы, пересчитывающие счётчики рассылок по campaign_history (для вставки в таблицу-ключ)."""
+    return {
+        "campaign_counters": f"""
+            SELECT task_id, COUNT(*),
+                SUM(CASE WHEN status = 'sent' THEN 1 ELSE 0 END),
+                SUM(CASE WHEN status = 'failed' THEN 1 ELSE 0 END),
+                COUNT(DISTINCT user_id)
+            FROM campaign_history {where} GROUP BY task_id
+        """,
+        "campaign_post_counters": f"""
+            SELECT task_id, post_id, COUNT(*),
+                SUM(CASE WHEN status = 'sent' THEN 1 ELSE 0 END),
+                SUM(CASE WHEN status = 'failed' THEN 1 ELSE 0 END),
+                COUNT(DISTINCT user_id)
+            FROM campaign_history {where} GROUP BY task_id, post_id
+        """,
+        "campaign_error_counters": f"""
+            SELECT task_id, post_id, COALESCE(error, 'unknown'), COUNT(*)
+            FROM campaign_history {where} {"AND" if where else "WHERE"} status = 'failed'
+            GROUP BY task_id, post_id, COALESCE(error, 'unknown')
+        """,
+    }
 
 
 def init_db():
@@ -111,6 +344,156 @@ def init_db():
             )
         """)
         
+        # group_id в истории появился вместе с журналом ответов
+        columns = {row["name"] for row in cursor.execute("PRAGMA table_info(campaign_history)")}
+        if "group_id" not in columns:
+            cursor.execute("ALTER TABLE campaign_history ADD COLUMN group_id INTEGER")
+        
+        # Журнал ответов рассылок: кому уже отвечали под постом. Первичный ключ —
+        # уникальный индекс для массовой проверки "уже получал ответ"
+        ledger_exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'reply_ledger'"
+        ).fetchone()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS reply_ledger (
+                group_id INTEGER NOT NULL,
+                post_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                task_id TEXT NOT NULL,
+                comment_id INTEGER NOT NULL,
+                replied_at TEXT,
+                PRIMARY KEY (group_id, post_id, user_id)
+            ) WITHOUT ROWID
+        """)
+        if not ledger_exists:
+            # Первое создание: строим журнал из уже отправленных ответов. У старых
+            # записей без group_id сообщество определяется, только если оно
+            # однозначно: post_id — счётчик своей стены, один номер поста бывает
+            # в нескольких сообществах. Неоднозначные записи пропускаются
+            cursor.execute("""
+                INSERT OR IGNORE INTO reply_ledger 
+                (group_id, post_id, user_id, task_id, comment_id, replied_at)
+                SELECT group_id, post_id, user_id, task_id, comment_id, sent_at FROM (
+                    SELECT 
+                        COALESCE(ch.group_id, (
+                            SELECT CASE
+                                WHEN COUNT(DISTINCT ps.group_id) = 1 THEN MIN(ps.group_id)
+                                WHEN COUNT(*) = 0 THEN ?
+                            END
+                            FROM post_stats ps WHERE ps.post_id = ch.post_id
+                        )) AS group_id,
+                        ch.post_id, ch.user_id, ch.task_id, ch.comment_id, ch.sent_at
+                    FROM campaign_history ch
+                    WHERE ch.status = 'sent'
+                    ORDER BY ch.id
+                )
+                WHERE group_id IS NOT NULL
+            """, (_single_group_id(),))
+        
+        # Кэш сбора комментариев: курсор поста и его участники с первым и
+        # последним комментарием. Повторный сбор дочитывает только новые
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS comment_cursors (
+                group_id INTEGER NOT NULL,
+                post_id INTEGER NOT NULL,
+                max_comment_id INTEGER NOT NULL,
+                comments INTEGER NOT NULL,
+                full_read_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (group_id, post_id)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS comment_authors (
+                group_id INTEGER NOT NULL,
+                post_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                first_comment_id INTEGER NOT NULL,
+                last_comment_id INTEGER NOT NULL,
+                PRIMARY KEY (group_id, post_id, user_id)
+            ) WITHOUT ROWID
+        """)
+        
+        # Счётчики рассылок: по задаче, по посту и по классам ошибок. Обновляются
+        # в одной транзакции с записями campaign_history, статистика их только читает
+        counters_exist = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'campaign_counters'"
+        ).fetchone()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS campaign_counters (
+                task_id TEXT PRIMARY KEY,
+                total INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                unique_users INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS campaign_post_counters (
+                task_id TEXT NOT NULL,
+                post_id INTEGER NOT NULL,
+                total INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                unique_users INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (task_id, post_id)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS campaign_error_counters (
+                task_id TEXT NOT NULL,
+                post_id INTEGER NOT NULL,
+                error TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (task_id, post_id, error)
+            ) WITHOUT ROWID
+        """)
+        # Дневные итоги рассылок: сюда сворачиваются строки campaign_history,
+        # удаляемые по сроку хранения
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS campaign_daily (
+                task_id TEXT NOT NULL,
+                post_id INTEGER NOT NULL,
+                day TEXT NOT NULL,
+                total INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (task_id, post_id, day)
+            ) WITHOUT ROWID
+        """)
+        if not counters_exist:
+            # Первое создание: считаем счётчики по уже накопленной истории
+            for table, sql in _recount_queries("").items():
+                cursor.execute(f"INSERT INTO {table} {sql}")
+        
+        # Журнал задач: только дописывается, строки читаются страницами по seq
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS task_logs (
+                task_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                created_at TEXT NOT NULL,
+                message TEXT NOT NULL,
+                PRIMARY KEY (task_id, seq)
+            ) WITHOUT ROWID
+        """)
+        
+        # Таблица автоответов и их курсоров для продолжения после перезапуска
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS watchers (
+                id TEXT PRIMARY KEY,
+                group_id INTEGER NOT NULL,
+                post_id INTEGER NOT NULL,
+                message TEXT NOT NULL,
+                status TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                replied INTEGER DEFAULT 0,
+                errors INTEGER DEFAULT 0,
+                last_seen_comment INTEGER DEFAULT 0,
+                log TEXT,
+                updated_at TEXT NOT NULL
+            )
+        """)
+        
         # Индексы для быстрого поиска
         cursor.execute("""
             CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks(status)
@@ -118,12 +501,17 @@ def init_db():
         cursor.execute("""
             CREATE INDEX IF NOT EXISTS idx_tasks_created ON tasks(created_at)
         """)
+        # (task_id, user_id): выборка задачи и проверка "уже в счётчике уникальных"
+        cursor.execute("DROP INDEX IF EXISTS idx_campaign_task")
         cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_campaign_task ON campaign_history(task_id)
+            CREATE INDEX IF NOT EXISTS idx_campaign_task_user ON campaign_history(task_id, user_id)
         """)
         cursor.execute("""
             CREATE INDEX IF NOT EXISTS idx_campaign_user ON campaign_history(user_id)
         """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_watchers_status ON watchers(status)
+        """)
 
 
 def save_task(task_data: Dict[str, Any]) -> None:
@@ -207,6 +595,58 @@ def update_task_status(task_id: str, status: str, **kwargs) -> None:
         )
 
 
+def save_task_logs(entries: List[Tuple[Any, ...]]) -> None:
+    """
+    Дописывает пачку строк журнала задач одной транзакцией.
+    Запись: (task_id, seq, created_at, message).
+    """
+    if not entries:
+        return
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("""
+            INSERT OR IGNORE INTO task_logs (task_id, seq, created_at, message)
+            VALUES (?, ?, ?, ?)
+        """, entries)
+
+
+def get_task_logs(task_id: str, after: int = 0, limit: int = 200) -> List[Dict[str, Any]]:
+    """Строки журнала задачи с seq больше after, по порядку."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT seq, created_at, message FROM task_logs 
+            WHERE task_id = ? AND seq > ? 
+            ORDER BY seq 
+            LIMIT ?
+        """, (task_id, after, limit))
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def get_task_log_tail(task_id: str, limit: int = 80) -> List[str]:
+    """Последние строки журнала задачи (для карточки задачи)."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT message FROM task_logs 
+            WHERE task_id = ? 
+            ORDER BY seq DESC 
+            LIMIT ?
+        """, (task_id, limit))
+        return [row["message"] for row in reversed(cursor.fetchall())]
+
+
+class TaskLogWriter(BatchWriter):
+    """Буфер строк task_logs одной задачи."""
+
+    def __init__(self, task_id: str, **kwargs: Any) -> None:
+        super().__init__(save_task_logs, **kwargs)
+        self.task_id = task_id
+
+    def add(self, seq: int, message: str) -> None:
+        self.add_row((self.task_id, seq, datetime.utcnow().isoformat(), message))
+
+
 def save_post_stats(group_id: int, post_id: int, stats: Dict[str, Any]) -> None:
     """Сохраняет статистику поста."""
     today = datetime.utcnow().date().isoformat()
@@ -246,6 +686,47 @@ def save_user_info(user_id: int, user_data: Dict[str, Any]) -> None:
         ))
 
 
+def save_users_info(users: List[Dict[str, Any]]) -> None:
+    """Сохраняет информацию о пачке пользователей одним запросом."""
+    if not users:
+        return
+    now = datetime.utcnow().isoformat()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("""
+            INSERT OR REPLACE INTO users 
+            (user_id, first_name, last_name, photo_url, last_seen, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [
+            (
+                user["id"],
+                user.get("first_name"),
+                user.get("last_name"),
+                user.get("photo_url"),
+                user.get("last_seen"),
+                now,
+            )
+            for user in users
+        ])
+
+
+def get_fresh_user_ids(user_ids: List[int], since: datetime) -> Set[int]:
+    """Возвращает пользователей, чья информация обновлялась не раньше since."""
+    fresh: Set[int] = set()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        # SQLite ограничивает число параметров в запросе
+        for i in range(0, len(user_ids), 900):
+            chunk = user_ids[i:i+900]
+            placeholders = ",".join("?" * len(chunk))
+            cursor.execute(
+                f"SELECT user_id FROM users WHERE updated_at >= ? AND user_id IN ({placeholders})",
+                [since.isoformat(), *chunk]
+            )
+            fresh.update(row["user_id"] for row in cursor.fetchall())
+    return fresh
+
+
 def save_group_info(group_id: int, group_data: Dict[str, Any]) -> None:
     """Сохраняет информацию о группе."""
     with get_db() as conn:
@@ -278,17 +759,214 @@ def get_group_info(group_id: int) -> Optional[Dict[str, Any]]:
 
 def save_campaign_entry(
     task_id: str, user_id: int, post_id: int, comment_id: int, 
-    status: str, error: Optional[str] = None
+    status: str, error: Optional[str] = None, group_id: Optional[int] = None
 ) -> None:
     """Сохраняет запись об отправке сообщения пользователю."""
+    save_campaign_entries([(
+        task_id,
+        group_id,
+        user_id,
+        post_id,
+        comment_id,
+        status,
+        datetime.utcnow().isoformat() if status == "sent" else None,
+        error,
+    )])
+
+
+def save_campaign_entries(entries: List[Tuple[Any, ...]]) -> None:
+    """
+    Сохраняет пачку записей campaign_history одной транзакцией, вместе с
+    отметками в reply_ledger для отправленных.
+    Запись: (task_id, group_id, user_id, post_id, comment_id, status, sent_at, error).
+    """
+    if not entries:
+        return
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
+        # Счётчики — до вставки: уникальность проверяется по уже записанной истории
+        _count_campaign_entries(cursor, entries)
+        cursor.executemany("""
             INSERT INTO campaign_history 
-            (task_id, user_id, post_id, comment_id, status, sent_at, error)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (
-            task_id,
+            (task_id, group_id, user_id, post_id, comment_id, status, sent_at, error)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, entries)
+        cursor.executemany("""
+            INSERT OR IGNORE INTO reply_ledger 
+            (group_id, post_id, user_id, task_id, comment_id, replied_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [
+            (group_id, post_id, user_id, task_id, comment_id, sent_at)
+            for task_id, group_id, user_id, post_id, comment_id, status, sent_at, _ in entries
+            if status == "sent" and group_id is not None
+        ])
+
+
+def _count_campaign_entries(cursor: sqlite3.Cursor, entries: List[Tuple[Any, ...]]) -> None:
+    """Прибавляет пачку записей campaign_history к счётчикам рассылок."""
+    by_task: Dict[str, List[Tuple[Any, ...]]] = {}
+    for entry in entries:
+        by_task.setdefault(entry[0], []).append(entry)
+
+    for task_id, rows in by_task.items():
+        # Кто из пачки уже есть в истории задачи (и под каким постом)
+        seen: Set[Tuple[int, int]] = set()
+        user_ids = list({row[2] for row in rows})
+        for i in range(0, len(user_ids), 900):
+            chunk = user_ids[i:i+900]
+            placeholders = ",".join("?" * len(chunk))
+            cursor.execute(
+                f"SELECT DISTINCT user_id, post_id FROM campaign_history "
+                f"WHERE task_id = ? AND user_id IN ({placeholders})",
+                [task_id, *chunk]
+            )
+            seen.update((row["user_id"], row["post_id"]) for row in cursor.fetchall())
+        seen_users = {user_id for user_id, _ in seen}
+
+        task = [0, 0, 0, 0]  # total, sent, failed, unique_users
+        posts: Dict[int, List[int]] = {}
+        errors: Dict[Tuple[int, str], int] = {}
+        for _, _, user_id, post_id, _, status, _, error in rows:
+            post = posts.setdefault(post_id, [0, 0, 0, 0])
+            for counter in (task, post):
+                counter[0] += 1
+                if status == "sent":
+                    counter[1] += 1
+                elif status == "failed":
+                    counter[2] += 1
+            if user_id not in seen_users:
+                seen_users.add(user_id)
+                task[3] += 1
+            if (user_id, post_id) not in seen:
+                seen.add((user_id, post_id))
+                post[3] += 1
+            if status == "failed":
+                key = (post_id, error or "unknown")
+                errors[key] = errors.get(key, 0) + 1
+
+        cursor.execute("""
+            INSERT INTO campaign_counters (task_id, total, sent, failed, unique_users)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (task_id) DO UPDATE SET
+                total = total + excluded.total,
+                sent = sent + excluded.sent,
+                failed = failed + excluded.failed,
+                unique_users = unique_users + excluded.unique_users
+        """, (task_id, *task))
+        cursor.executemany("""
+            INSERT INTO campaign_post_counters (task_id, post_id, total, sent, failed, unique_users)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (task_id, post_id) DO UPDATE SET
+                total = total + excluded.total,
+                sent = sent + excluded.sent,
+                failed = failed + excluded.failed,
+                unique_users = unique_users + excluded.unique_users
+        """, [(task_id, post_id, *counter) for post_id, counter in posts.items()])
+        cursor.executemany("""
+            INSERT INTO campaign_error_counters (task_id, post_id, error, count)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (task_id, post_id, error) DO UPDATE SET count = count + excluded.count
+        """, [(task_id, post_id, error, count) for (post_id, error), count in errors.items()])
+
+
+def get_replied_user_ids(group_id: int, post_id: int, user_ids: List[int]) -> Set[int]:
+    """Кто из user_ids уже получал ответ рассылки под этим постом (по reply_ledger)."""
+    replied: Set[int] = set()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        # SQLite ограничивает число параметров в запросе
+        for i in range(0, len(user_ids), 900):
+            chunk = user_ids[i:i+900]
+            placeholders = ",".join("?" * len(chunk))
+            cursor.execute(
+                f"SELECT user_id FROM reply_ledger "
+                f"WHERE group_id = ? AND post_id = ? AND user_id IN ({placeholders})",
+                [group_id, post_id, *chunk]
+            )
+            replied.update(row["user_id"] for row in cursor.fetchall())
+    return replied
+
+
+def get_comment_cache(group_id: int, post_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Кэш сбора комментариев поста: курсор (max_comment_id, comments, full_read_at)
+    и authors — [(user_id, first_comment_id, last_comment_id), ...].
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT * FROM comment_cursors WHERE group_id = ? AND post_id = ?",
+            (group_id, post_id)
+        )
+        row = cursor.fetchone()
+        if not row:
+            return None
+        cursor.execute(
+            "SELECT user_id, first_comment_id, last_comment_id FROM comment_authors "
+            "WHERE group_id = ? AND post_id = ?",
+            (group_id, post_id)
+        )
+        data = dict(row)
+        data["authors"] = [tuple(r) for r in cursor.fetchall()]
+        return data
+
+
+def save_comment_cache(
+    group_id: int,
+    post_id: int,
+    max_comment_id: int,
+    comments: int,
+    authors: List[Tuple[int, int, int]],
+    full_read: bool = False,
+) -> None:
+    """
+    Сохраняет результат сбора: новый курсор и участников из прочитанных
+    комментариев (user_id, first_comment_id, last_comment_id). Полное чтение
+    заменяет кэш поста, дочитывание — дописывается к нему.
+    """
+    now = datetime.utcnow().isoformat()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        if full_read:
+            cursor.execute(
+                "DELETE FROM comment_authors WHERE group_id = ? AND post_id = ?",
+                (group_id, post_id)
+            )
+        cursor.executemany("""
+            INSERT INTO comment_authors 
+            (group_id, post_id, user_id, first_comment_id, last_comment_id)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (group_id, post_id, user_id) DO UPDATE SET
+                first_comment_id = MIN(first_comment_id, excluded.first_comment_id),
+                last_comment_id = MAX(last_comment_id, excluded.last_comment_id)
+        """, [(group_id, post_id, *author) for author in authors])
+        cursor.execute("""
+            INSERT INTO comment_cursors 
+            (group_id, post_id, max_comment_id, comments, full_read_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (group_id, post_id) DO UPDATE SET
+                max_comment_id = MAX(max_comment_id, excluded.max_comment_id),
+                comments = excluded.comments,
+                full_read_at = CASE WHEN ? THEN excluded.full_read_at ELSE full_read_at END,
+                updated_at = excluded.updated_at
+        """, (group_id, post_id, max_comment_id, comments, now, now, full_read))
+
+
+class CampaignHistoryWriter(BatchWriter):
+    """Буфер записей campaign_history (и reply_ledger) одной задачи."""
+
+    def __init__(self, task_id: str, group_id: Optional[int] = None, **kwargs: Any) -> None:
+        super().__init__(save_campaign_entries, **kwargs)
+        self.task_id = task_id
+        self.group_id = group_id
+
+    def add(
+        self, user_id: int, post_id: int, comment_id: int,
+        status: str, error: Optional[str] = None
+    ) -> None:
+        self.add_row((
+            self.task_id,
+            self.group_id,
             user_id,
             post_id,
             comment_id,
@@ -299,19 +977,316 @@ def save_campaign_entry(
 
 
 def get_campaign_stats(task_id: str) -> Dict[str, Any]:
-    """Получает статистику по кампании."""
+    """
+    Статистика кампании по счётчикам (без обхода campaign_history): итоги,
+    уникальные участники, ошибки по классам и разбивка по постам.
+    """
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT 
-                COUNT(*) as total,
-                SUM(CASE WHEN status = 'sent' THEN 1 ELSE 0 END) as sent,
-                SUM(CASE WHEN status = 'failed' THEN 1 ELSE 0 END) as failed
-            FROM campaign_history
-            WHERE task_id = ?
-        """, (task_id,))
+        cursor.execute("SELECT * FROM campaign_counters WHERE task_id = ?", (task_id,))
         row = cursor.fetchone()
-        return dict(row) if row else {"total": 0, "sent": 0, "failed": 0}
+        stats: Dict[str, Any] = {"total": 0, "sent": 0, "failed": 0, "unique_users": 0}
+        if row:
+            stats.update({key: row[key] for key in stats})
+        
+        cursor.execute(
+            "SELECT post_id, total, sent, failed, unique_users FROM campaign_post_counters "
+            "WHERE task_id = ? ORDER BY post_id",
+            (task_id,)
+        )
+        posts = {row["post_id"]: dict(row, errors={}) for row in cursor.fetchall()}
+        
+        errors: Dict[str, int] = {}
+        cursor.execute(
+            "SELECT post_id, error, count FROM campaign_error_counters WHERE task_id = ?",
+            (task_id,)
+        )
+        for row in cursor.fetchall():
+            errors[row["error"]] = errors.get(row["error"], 0) + row["count"]
+            if row["post_id"] in posts:
+                posts[row["post_id"]]["errors"][row["error"]] = row["count"]
+        
+        stats["errors"] = errors
+        stats["posts"] = list(posts.values())
+        return stats
+
+
+def get_campaign_task_ids() -> List[str]:
+    """Задачи, которые могут иметь историю или счётчики рассылки."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        # Задачи, чья история уже свёрнута в campaign_daily, по истории не сверяются
+        cursor.execute("""
+            SELECT id AS task_id FROM tasks
+            UNION
+            SELECT task_id FROM campaign_counters
+            EXCEPT
+            SELECT DISTINCT task_id FROM campaign_daily
+        """)
+        return [row["task_id"] for row in cursor.fetchall()]
+
+
+def reconcile_campaign_counters(task_id: str) -> bool:
+    """
+    Сверяет счётчики задачи с её campaign_history (выборка по индексу задачи)
+    и при расхождении перезаписывает их. Возвращает True, если был дрейф.
+    """
+    where = "WHERE task_id = ?"
+    with get_db() as conn:
+        cursor = conn.cursor()
+        drift = False
+        for table, sql in _recount_queries(where).items():
+            expected = sorted(tuple(row) for row in cursor.execute(sql, (task_id,)))
+            stored = sorted(
+                tuple(row) for row in cursor.execute(f"SELECT * FROM {table} {where}", (task_id,))
+            )
+            if expected != stored:
+                drift = True
+                cursor.execute(f"DELETE FROM {table} {where}", (task_id,))
+                cursor.execute(f"INSERT INTO {table} {sql}", (task_id,))
+        return drift
+
+
+def save_watchers(watchers: List[Dict[str, Any]]) -> None:
+    """Сохраняет состояние пачки автоответов (чекпоинт курсоров) одним запросом."""
+    if not watchers:
+        return
+    now = datetime.utcnow().isoformat()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("""
+            INSERT OR REPLACE INTO watchers 
+            (id, group_id, post_id, message, status, created_at, replied, errors,
+             last_seen_comment, log, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [
+            (
+                watcher["id"],
+                watcher["group_id"],
+                watcher["post_id"],
+                watcher["message"],
+                watcher["status"],
+                watcher["created_at"],
+                watcher.get("replied", 0),
+                watcher.get("errors", 0),
+                watcher.get("last_seen_comment", 0),
+                json.dumps(watcher.get("log", [])),
+                now,
+            )
+            for watcher in watchers
+        ])
+
+
+def get_running_watchers() -> List[Dict[str, Any]]:
+    """Автоответы, которые работали на момент остановки процесса."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT * FROM watchers 
+            WHERE status = 'running' 
+            ORDER BY created_at
+        """)
+        return [dict(row) for row in cursor.fetchall()]
+
+
+# --- Хранение истории: сводки, удаление пачками, очистка страниц ---
+
+def get_expired_task_ids(before: str) -> List[str]:
+    """Задачи, созданные раньше before (ISO), от старых к новым."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id FROM tasks WHERE created_at < ? ORDER BY created_at", (before,)
+        )
+        return [row["id"] for row in cursor.fetchall()]
+
+
+def rollup_history_batch(task_id: str, limit: int) -> int:
+    """
+    Сворачивает до limit строк campaign_history задачи в campaign_daily и
+    удаляет их — одной транзакцией, так что прерванная очистка ничего не
+    посчитает дважды. Возвращает число удалённых строк.
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id FROM campaign_history WHERE task_id = ? LIMIT ?", (task_id, limit)
+        )
+        ids = [row["id"] for row in cursor.fetchall()]
+        if not ids:
+            return 0
+        placeholders = ",".join("?" * len(ids))
+        cursor.execute(f"""
+            INSERT INTO campaign_daily (task_id, post_id, day, total, sent, failed)
+            SELECT ch.task_id, ch.post_id,
+                date(COALESCE(ch.sent_at, t.completed_at, t.created_at, 'now')),
+                COUNT(*),
+                SUM(CASE WHEN ch.status = 'sent' THEN 1 ELSE 0 END),
+                SUM(CASE WHEN ch.status = 'failed' THEN 1 ELSE 0 END)
+            FROM campaign_history ch
+            LEFT JOIN tasks t ON t.id = ch.task_id
+            WHERE ch.id IN ({placeholders})
+            GROUP BY 1, 2, 3
+            ON CONFLICT (task_id, post_id, day) DO UPDATE SET
+                total = total + excluded.total,
+                sent = sent + excluded.sent,
+                failed = failed + excluded.failed
+        """, ids)
+        cursor.execute(f"DELETE FROM campaign_history WHERE id IN ({placeholders})", ids)
+        return len(ids)
+
+
+def prune_task_logs_batch(task_id: str, limit: int) -> int:
+    """Удаляет до limit самых старых строк журнала задачи."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            DELETE FROM task_logs WHERE task_id = ? AND seq IN (
+                SELECT seq FROM task_logs WHERE task_id = ? ORDER BY seq LIMIT ?
+            )
+        """, (task_id, task_id, limit))
+        return cursor.rowcount
+
+
+def delete_task(task_id: str) -> None:
+    """Удаляет строку задачи и её счётчики; дневные сводки остаются."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        for table in ("campaign_counters", "campaign_post_counters", "campaign_error_counters"):
+            cursor.execute(f"DELETE FROM {table} WHERE task_id = ?", (task_id,))
+        cursor.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+
+
+def prune_post_stats_batch(before_date: str, limit: int) -> int:
+    """Удаляет до limit дневных снимков post_stats старше before_date (YYYY-MM-DD)."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            DELETE FROM post_stats WHERE rowid IN (
+                SELECT rowid FROM post_stats WHERE date < ? LIMIT ?
+            )
+        """, (before_date, limit))
+        return cursor.rowcount
+
+
+def get_stale_comment_caches(before: str) -> List[Tuple[int, int]]:
+    """Кэши сбора комментариев, полностью прочитанные раньше before (их всё равно перечитают)."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT group_id, post_id FROM comment_cursors WHERE full_read_at < ?", (before,)
+        )
+        return [(row["group_id"], row["post_id"]) for row in cursor.fetchall()]
+
+
+def prune_comment_cache_batch(group_id: int, post_id: int, limit: int) -> int:
+    """Удаляет до limit участников из кэша поста; курсор — вместе с последней пачкой."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            DELETE FROM comment_authors WHERE group_id = ? AND post_id = ? AND user_id IN (
+                SELECT user_id FROM comment_authors WHERE group_id = ? AND post_id = ? LIMIT ?
+            )
+        """, (group_id, post_id, group_id, post_id, limit))
+        deleted = cursor.rowcount
+        if deleted < limit:
+            cursor.execute(
+                "DELETE FROM comment_cursors WHERE group_id = ? AND post_id = ?",
+                (group_id, post_id)
+            )
+        return deleted
+
+
+def get_retention_report(
+    history_before: Optional[str],
+    tasks_before: Optional[str],
+    post_stats_before: Optional[str],
+    cache_before: Optional[str],
+) -> Dict[str, Any]:
+    """
+    Сколько строк удалит очистка по каждой таблице и примерно сколько места
+    освободит (доля строк от размера таблицы с индексами по dbstat, если он
+    есть). None вместо даты — правило отключено; history_before должен
+    покрывать и удаляемые задачи.
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        rows: Dict[str, int] = {}
+
+        def count(table: str, sql: str, params: Tuple[Any, ...]) -> None:
+            rows[table] = rows.get(table, 0) + cursor.execute(sql, params).fetchone()[0]
+
+        if history_before:
+            count("campaign_history", """
+                SELECT COUNT(*) FROM campaign_history
+                WHERE task_id IN (SELECT id FROM tasks WHERE created_at < ?)
+            """, (history_before,))
+            count("task_logs", """
+                SELECT COUNT(*) FROM task_logs
+                WHERE task_id IN (SELECT id FROM tasks WHERE created_at < ?)
+            """, (history_before,))
+        if tasks_before:
+            count("tasks", "SELECT COUNT(*) FROM tasks WHERE created_at < ?", (tasks_before,))
+        if post_stats_before:
+            count("post_stats", "SELECT COUNT(*) FROM post_stats WHERE date < ?", (post_stats_before,))
+        if cache_before:
+            count("comment_authors", """
+                SELECT COUNT(*) FROM comment_authors a JOIN comment_cursors c
+                ON c.group_id = a.group_id AND c.post_id = a.post_id
+                WHERE c.full_read_at < ?
+            """, (cache_before,))
+
+        page_size = cursor.execute("PRAGMA page_size").fetchone()[0]
+        freelist = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        sizes: Dict[str, int] = {}
+        try:
+            cursor.execute("""
+                SELECT COALESCE(m.tbl_name, d.name) AS tbl, SUM(d.pgsize) AS bytes
+                FROM dbstat d LEFT JOIN sqlite_master m ON m.name = d.name
+                GROUP BY tbl
+            """)
+            sizes = {row["tbl"]: row["bytes"] for row in cursor.fetchall()}
+        except sqlite3.OperationalError:
+            pass  # SQLite собран без dbstat: оценки места не будет
+
+        tables: Dict[str, Dict[str, Any]] = {}
+        reclaim = 0
+        for table, n in rows.items():
+            total = cursor.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            size = sizes.get(table)
+            estimate = size * n // total if size is not None and total else None
+            tables[table] = {"rows": n, "total_rows": total, "bytes": estimate}
+            reclaim += estimate or 0
+
+        return {
+            "tables": tables,
+            "free_bytes": freelist * page_size,
+            "reclaim_bytes": reclaim + freelist * page_size,
+            "db_bytes": cursor.execute("PRAGMA page_count").fetchone()[0] * page_size,
+            "incremental_vacuum": cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2,
+        }
+
+
+def enable_incremental_vacuum() -> bool:
+    """
+    Переводит старую базу на auto_vacuum=INCREMENTAL: это требует одного
+    полного VACUUM. Возвращает True, если перевод был выполнен сейчас.
+    """
+    conn = get_connection()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+    conn.commit()
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    return True
+
+
+def incremental_vacuum(pages: int) -> int:
+    """Возвращает системе до pages свободных страниц; отдаёт, сколько свободных осталось."""
+    conn = get_connection()
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    conn.commit()
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
 
 
 # Инициализация базы при импорте
@@ -0,0 +1,182 @@
+"""
+Bots Long Poll как источник новых комментариев для автоответов.
+
+На сообщество держится одно подключение (groups.getLongPollServer + a_check),
+события wall_reply_new раздаются подписчикам по post_id. Если Long Poll API
+у сообщества выключен или недоступен, либо событие wall_reply_new в нём не
+включено и включить его не удалось, источник помечается failed, и автоответы
+продолжают опрашивать wall.getComments.
+"""
+import asyncio
+from typing import Any, Dict, Optional, Set
+
+from ratelimit import json_loads
+from vk_service import VKService
+
+LONGPOLL_WAIT = 25
+# Пауза перед переподключением после сетевой ошибки
+RECONNECT_DELAY = 3.0
+MAX_CONNECT_ERRORS = 5
+
+# Событие в очереди подписчика: комментарий {"id", "from_id", "post_id"}
+# или RESYNC — история событий потеряна, нужно перечитать комментарии
+RESYNC: Dict[str, Any] = {"resync": True}
+
+
+class LongPollSource:
+    def __init__(self, client: VKService) -> None:
+        self.client = client
+        self.group_id = abs(client.owner_id)
+        self.status = "idle"  # idle | connecting | running | failed
+        self.error = ""
+        self._subscribers: Dict[int, Set["asyncio.Queue[Dict[str, Any]]"]] = {}
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    @property
+    def active(self) -> bool:
+        return self.status in ("connecting", "running")
+
+    def subscribe(
+        self, post_id: int, queue: Optional["asyncio.Queue[Dict[str, Any]]"] = None
+    ) -> "asyncio.Queue[Dict[str, Any]]":
+        """Подписка на комментарии поста; одну очередь можно подписать на несколько постов."""
+        if queue is None:
+            queue = asyncio.Queue()
+        self._subscribers.setdefault(post_id, set()).add(queue)
+        if self._task is None or self._task.done():
+            if self.status != "failed":
+                self.status = "connecting"
+                self._task = asyncio.create_task(self._run())
+        return queue
+
+    def unsubscribe(self, post_id: int, queue: "asyncio.Queue[Dict[str, Any]]") -> None:
+        queues = self._subscribers.get(post_id)
+        if queues:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[post_id]
+        if not self._subscribers and self._task:
+            self._task.cancel()
+            self._task = None
+            if self.status != "failed":
+                self.status = "idle"
+
+    def dispatch(self, update: Dict[str, Any]) -> None:
+        if update.get("type") != "wall_reply_new":
+            return
+        obj = update.get("object") or {}
+        if abs(int(obj.get("owner_id") or -self.group_id)) != self.group_id:
+            return
+        # Как и опрос wall.getComments, берём только комментарии верхнего уровня:
+        # ответы в ветках (в том числе наши автоответы) пропускаем
+        if obj.get("parents_stack"):
+            return
+        event = {"id": obj.get("id"), "from_id": obj.get("from_id"), "post_id": obj.get("post_id")}
+        for queue in self._subscribers.get(int(obj.get("post_id") or 0), ()):
+            queue.put_nowait(event)
+
+    def _broadcast(self, event: Dict[str, Any]) -> None:
+        queues = {queue for subscribed in self._subscribers.values() for queue in subscribed}
+        for queue in queues:
+            queue.put_nowait(event)
+
+    async def _get_server(self) -> Dict[str, Any]:
+        resp = await self.client.group_api.request(
+            "groups.getLongPollServer", {"group_id": self.group_id}
+        )
+        return resp.get("response", resp) if isinstance(resp, dict) else {}
+
+    async def _ensure_wall_events(self) -> None:
+        """
+        Long Poll может быть включён без события wall_reply_new — тогда
+        комментарии не придут никогда. Включаем его сами или падаем.
+        """
+        resp = await self.client.group_api.request(
+            "groups.getLongPollSettings", {"group_id": self.group_id}
+        )
+        settings = resp.get("response", resp) if isinstance(resp, dict) else {}
+        if (settings.get("events") or {}).get("wall_reply_new"):
+            return
+        await self.client.group_api.request(
+            "groups.setLongPollSettings", {"group_id": self.group_id, "wall_reply_new": 1}
+        )
+
+    async def _run(self) -> None:
+        errors = 0
+        try:
+            server = await self._get_server()
+        except Exception as exc:
+            self.status = "failed"
+            self.error = f"Long Poll недоступен: {exc}"
+            self._broadcast(RESYNC)
+            return
+        try:
+            await self._ensure_wall_events()
+        except Exception as exc:
+            self.status = "failed"
+            self.error = f"Long Poll не присылает новые комментарии (wall_reply_new): {exc}"
+            self._broadcast(RESYNC)
+            return
+
+        self.status = "running"
+        ts = server.get("ts")
+        while self._subscribers:
+            try:
+                body = await self.client.http_client.request_content(
+                    server["server"],
+                    method="GET",
+                    params={"act": "a_check", "key": server["key"], "ts": ts, "wait": LONGPOLL_WAIT},
+                )
+                data = json_loads(body)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                errors += 1
+                if errors >= MAX_CONNECT_ERRORS:
+                    self.status = "failed"
+                    self.error = f"Long Poll отключён после ошибок: {exc}"
+                    self._broadcast(RESYNC)
+                    return
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+
+            errors = 0
+            failed = data.get("failed")
+            if failed == 1:
+                # История частично потеряна — подписчики перечитают комментарии сами
+                ts = data.get("ts", ts)
+                self._broadcast(RESYNC)
+                continue
+            if failed in (2, 3):
+                try:
+                    server = await self._get_server()
+                except Exception as exc:
+                    self.status = "failed"
+                    self.error = f"Long Poll недоступен: {exc}"
+                    self._broadcast(RESYNC)
+                    return
+                ts = server.get("ts") if failed == 3 else ts
+                self._broadcast(RESYNC)
+                continue
+
+            ts = data.get("ts", ts)
+            for update in data.get("updates") or []:
+                self.dispatch(update)
+
+
+class LongPollHub:
+    """Реестр источников Long Poll по сообществам."""
+
+    def __init__(self) -> None:
+        self.sources: Dict[int, LongPollSource] = {}
+
+    def get(self, client: VKService) -> LongPollSource:
+        group_id = abs(client.owner_id)
+        source = self.sources.get(group_id)
+        if source is None or source.client is not client:
+            source = LongPollSource(client)
+            self.sources[group_id] = source
+        return source
+
+
+longpoll = LongPollHub()
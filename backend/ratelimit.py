@@ -0,0 +1,138 @@
+"""
+Общий для всего процесса ограничитель частоты запросов к VK API.
+
+Лимиты VK считаются по токену, поэтому и ведро токенов одно на ключ доступа:
+все VKService, задачи и автоответы с одним токеном делят общий бюджет.
+"""
+import asyncio
+import json
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from vkbottle import API
+from vkbottle.exception_factory import VKAPIError
+
+try:
+    import orjson
+
+    json_loads: Callable[[bytes], Any] = orjson.loads
+except ImportError:  # orjson ставится из requirements.txt; без него — стандартный json
+    json_loads = json.loads
+
+# Документированные лимиты VK API (запросов в секунду на один ключ)
+USER_TOKEN_RPS = 3.0
+GROUP_TOKEN_RPS = 20.0
+
+# Код ошибки VK "Too many requests per second"
+TOO_MANY_REQUESTS = 6
+FLOOD_RETRIES = 3
+
+
+class TokenBucket:
+    """
+    Ведро токенов с адаптацией к ошибке 6: при флуде скорость уменьшается вдвое,
+    после успешных запросов постепенно возвращается к базовой.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0) -> None:
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.floods = 0
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_flood(self) -> None:
+        self._refill()
+        self.floods += 1
+        self.rate = max(self.base_rate / 8, self.rate / 2)
+        self.tokens = min(self.tokens, 0.0)
+
+    def on_success(self) -> None:
+        if self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate + self.base_rate / 20)
+
+    def snapshot(self) -> Dict[str, float]:
+        return {"rate": round(self.rate, 2), "base_rate": self.base_rate, "floods": self.floods}
+
+
+_limiters: Dict[str, TokenBucket] = {}
+
+
+def get_limiter(token: str, rate: float) -> TokenBucket:
+    """Возвращает общее ведро для токена, создавая его при первом обращении."""
+    limiter = _limiters.get(token)
+    if limiter is None:
+        limiter = TokenBucket(rate)
+        _limiters[token] = limiter
+    return limiter
+
+
+class LimitedAPI(API):
+    """
+    vkbottle API, который перед каждым запросом ждёт разрешения у ведра своего
+    токена и повторяет запрос при ошибке 6 после замедления ведра.
+    """
+
+    def __init__(self, token: str, rate: float, **kwargs) -> None:
+        super().__init__(token, **kwargs)
+        self.token = token
+        self.limiter = get_limiter(token, rate)
+
+    async def request(self, method: str, data: dict) -> dict:
+        return await self._limited(lambda: super(LimitedAPI, self).request(method, data))
+
+    async def request_fast(self, method: str, data: dict) -> Any:
+        """
+        Лёгкий путь для массовых чтений: без валидаторов и debug-лога vkbottle,
+        тело ответа разбирается из байтов (orjson, если установлен).
+        Возвращает содержимое "response"; ошибки VK поднимаются как VKAPIError.
+        """
+
+        async def call() -> Any:
+            body = await self.http_client.request_content(
+                self.API_URL + method,
+                method="POST",
+                data={key: str(value) for key, value in data.items()},
+                params={"access_token": self.token, "v": self.API_VERSION},
+            )
+            payload = json_loads(body)
+            error = payload.get("error")
+            if error:
+                raise VKAPIError[error.get("error_code", 1)](
+                    error_msg=error.get("error_msg", ""),
+                    request_params=error.get("request_params"),
+                )
+            return payload.get("response")
+
+        return await self._limited(call)
+
+    async def _limited(self, call: Callable[[], Awaitable[Any]]) -> Any:
+        attempt = 0
+        while True:
+            await self.limiter.acquire()
+            try:
+                response = await call()
+            except VKAPIError[TOO_MANY_REQUESTS]:
+                self.limiter.on_flood()
+                attempt += 1
+                if attempt > FLOOD_RETRIES:
+                    raise
+                continue
+            self.limiter.on_success()
+            return response
@@ -0,0 +1,149 @@
+"""
+Хранение истории в bot.db: сроки, сводки и очистка.
+
+Строки campaign_history старых задач сворачиваются в дневные итоги
+campaign_daily и удаляются пачками по RETENTION_BATCH строк — каждая пачка
+отдельной записью в очереди потока записи, чтобы рассылки и автоответы не
+ждали очистку. Вместе с историей уходят журналы задач, затем сами задачи,
+старые снимки post_stats и устаревшие кэши сбора комментариев. Освободившиеся
+страницы возвращаются системе через incremental_vacuum небольшими шагами.
+
+Базу, созданную до auto_vacuum=INCREMENTAL, переводит только явный запуск с
+convert_vacuum: это полный VACUUM, который держит поток записи на время
+перезаписи файла и требует места на диске размером с саму базу.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from database import (
+    db_read, db_write, delete_task, enable_incremental_vacuum, get_expired_task_ids,
+    get_retention_report, get_stale_comment_caches, incremental_vacuum,
+    prune_comment_cache_batch, prune_post_stats_batch, prune_task_logs_batch,
+    rollup_history_batch
+)
+from storage import BotConfig, load_config
+from tasks import tasks
+from watchers import watchers
+
+logger = logging.getLogger(__name__)
+
+# Строк на одну транзакцию удаления
+RETENTION_BATCH = 500
+# Страниц на один шаг incremental_vacuum
+VACUUM_STEP_PAGES = 256
+
+
+def _cutoffs(cfg: BotConfig) -> Dict[str, Optional[str]]:
+    """Границы по правилам хранения (ISO); None — правило отключено."""
+    now = datetime.utcnow()
+
+    def before(days: float) -> Optional[str]:
+        return (now - timedelta(days=days)).isoformat() if days else None
+
+    tasks_before = before(cfg.tasks_retention_days)
+    history_before = before(cfg.history_retention_days)
+    # Удаляемая задача уносит и свою историю: граница истории — не раньше границы задач
+    if tasks_before and (not history_before or tasks_before > history_before):
+        history_before = tasks_before
+    post_stats_before = before(cfg.post_stats_retention_days)
+    return {
+        "history_before": history_before,
+        "tasks_before": tasks_before,
+        "post_stats_before": post_stats_before[:10] if post_stats_before else None,
+        # Кэш старше TTL всё равно перечитывается целиком; без TTL кэш не используется вовсе
+        "cache_before": before(cfg.comment_cache_ttl_hours / 24) if cfg.comment_cache_ttl_hours else now.isoformat(),
+    }
+
+
+def _writers_busy() -> bool:
+    """Идут рассылки или автоответы — полный VACUUM задержал бы их записи."""
+    return any(tasks.is_active(task_id) for task_id in list(tasks.tasks)) or any(
+        state.status == "running" for state in watchers.watchers.values()
+    )
+
+
+async def retention_report(cfg: BotConfig) -> Dict[str, Any]:
+    """Пробный прогон: что и сколько удалит очистка, ничего не меняя."""
+    cutoffs = _cutoffs(cfg)
+    report = await db_read(get_retention_report, **cutoffs)
+    report["cutoffs"] = cutoffs
+    report["dry_run"] = True
+    # Без инкрементального режима освобождённые страницы переиспользуются внутри
+    # файла, но сам файл не уменьшается, пока базу не перевели
+    report["vacuum_conversion"] = {
+        "pending": not report["incremental_vacuum"],
+        "requires_free_disk_bytes": 0 if report["incremental_vacuum"] else report["db_bytes"],
+        "blocked_by_active_work": _writers_busy(),
+    }
+    return report
+
+
+async def _drain(batch: Any, *args: Any) -> int:
+    """Повторяет удаление пачками, пока есть что удалять."""
+    removed = 0
+    while True:
+        n = await db_write(batch, *args, RETENTION_BATCH)
+        removed += n
+        if n < RETENTION_BATCH:
+            return removed
+
+
+async def run_retention(cfg: BotConfig, convert_vacuum: bool = False) -> Dict[str, Any]:
+    """
+    Очистка по правилам хранения; возвращает, сколько строк удалено по таблицам.
+    convert_vacuum — разрешить разовый перевод старой базы на инкрементальную
+    очистку (полный VACUUM); при идущих рассылках и автоответах он откладывается.
+    """
+    cutoffs = _cutoffs(cfg)
+    removed: Dict[str, int] = {
+        "campaign_history": 0, "task_logs": 0, "tasks": 0, "post_stats": 0, "comment_authors": 0,
+    }
+
+    if cutoffs["history_before"]:
+        expired_tasks = set(await db_read(get_expired_task_ids, cutoffs["tasks_before"])) \
+            if cutoffs["tasks_before"] else set()
+        for task_id in await db_read(get_expired_task_ids, cutoffs["history_before"]):
+            if tasks.is_active(task_id):
+                continue
+            removed["campaign_history"] += await _drain(rollup_history_batch, task_id)
+            removed["task_logs"] += await _drain(prune_task_logs_batch, task_id)
+            if task_id in expired_tasks:
+                await db_write(delete_task, task_id)
+                tasks.tasks.pop(task_id, None)
+                removed["tasks"] += 1
+
+    if cutoffs["post_stats_before"]:
+        removed["post_stats"] = await _drain(prune_post_stats_batch, cutoffs["post_stats_before"])
+
+    if cutoffs["cache_before"]:
+        for group_id, post_id in await db_read(get_stale_comment_caches, cutoffs["cache_before"]):
+            removed["comment_authors"] += await _drain(prune_comment_cache_batch, group_id, post_id)
+
+    converted = False
+    if convert_vacuum:
+        if _writers_busy():
+            logger.info("Перевод на incremental vacuum отложен: идут рассылки или автоответы")
+        else:
+            converted = await db_write(enable_incremental_vacuum)
+    # В старой базе без перевода incremental_vacuum ничего не делает
+    free_pages = await db_write(incremental_vacuum, VACUUM_STEP_PAGES)
+    while free_pages:
+        left = await db_write(incremental_vacuum, VACUUM_STEP_PAGES)
+        if left >= free_pages:
+            break
+        free_pages = left
+
+    logger.info("Очистка истории: удалено %s, перевод на incremental vacuum: %s", removed, converted)
+    return {"removed": removed, "cutoffs": cutoffs, "vacuum_converted": converted, "dry_run": False}
+
+
+async def run_retention_loop(interval_hours: float) -> None:
+    """Фоновая очистка раз в interval_hours; правила берутся из текущего конфига."""
+    while True:
+        await asyncio.sleep(interval_hours * 3600)
+        try:
+            await run_retention(load_config())
+        except Exception:
+            logger.exception("Очистка истории не удалась")
@@ -1,6 +1,6 @@
 import json
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Callable, Dict, List
 
 from pydantic import BaseModel, Field, ValidationError
 
@@ -15,12 +15,16 @@ from config import (
 
 CONFIG_PATH = Path(__file__).parent.parent / "data" / "config.json"
 
+ConfigListener = Callable[["BotConfig"], None]
+_config_listeners: List[ConfigListener] = []
+
 
 class Community(BaseModel):
     name: str = Field("", description="Friendly community name")
     group_id: int = Field(..., description="VK group id without minus")
     user_token: str = Field("", description="User token used to read comments")
     group_token: str = Field("", description="Group token used to reply")
+    send_concurrency: int = Field(5, ge=1, le=20, description="Max replies in flight at once")
 
 
 class BotConfig(BaseModel):
@@ -34,6 +38,26 @@ class BotConfig(BaseModel):
     request_delay: float = Field(REQUEST_DELAY, ge=0.05, le=30.0)
     promo_message: str = Field(PROMO_MESSAGE, description="Reply text")
     post_ids: list[int] = Field(default_factory=list, description="Selected post ids")
+    streaming_campaign: bool = Field(False, description="Start replying while comments are still being collected")
+    collect_concurrency: int = Field(3, ge=1, le=10, description="Posts collected in parallel")
+    collect_via_execute: bool = Field(True, description="Read comments in batches of 25 pages via execute")
+    comment_cache_ttl_hours: float = Field(
+        24.0, ge=0.0, le=720.0,
+        description="Re-read collected posts in full after N hours, in between fetch only new comments; 0 disables"
+    )
+    progress_save_interval: float = Field(2.0, ge=0.1, le=60.0, description="Seconds between task progress saves")
+    progress_save_every: int = Field(500, ge=1, le=100000, description="Save task progress at least every N events")
+    stats_reconcile_hours: float = Field(
+        6.0, ge=0.0, le=168.0, description="Hours between campaign counter reconciliations, 0 disables"
+    )
+    history_retention_days: int = Field(
+        90, ge=0, le=3650, description="Roll up and prune per-recipient history and task logs older than N days, 0 keeps"
+    )
+    tasks_retention_days: int = Field(365, ge=0, le=3650, description="Delete tasks older than N days, 0 keeps")
+    post_stats_retention_days: int = Field(180, ge=0, le=3650, description="Delete post stats snapshots older than N days, 0 keeps")
+    retention_interval_hours: float = Field(
+        24.0, ge=0.0, le=720.0, description="Hours between retention runs, 0 disables the background job"
+    )
 
 
 DEFAULT_CONFIG = {
@@ -110,9 +134,17 @@ def load_config() -> BotConfig:
     return cfg
 
 
+def on_config_saved(listener: ConfigListener) -> ConfigListener:
+    """Регистрирует обработчик, вызываемый после каждого save_config."""
+    _config_listeners.append(listener)
+    return listener
+
+
 def save_config(cfg: BotConfig) -> None:
     CONFIG_PATH.parent.mkdir(parents=True, exist_ok=True)
     CONFIG_PATH.write_text(_model_dump_json(cfg))
+    for listener in _config_listeners:
+        listener(cfg)
 
 
 def update_config(partial_data: Dict[str, Any]) -> BotConfig:
@@ -1,16 +1,21 @@
 import asyncio
 import uuid
+from collections import deque
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Dict, List
+from typing import Deque, Dict, List, Optional
 
 from storage import BotConfig
-from vk_service import VKService
+from vk_service import clients
 from database import (
-    save_task, update_task_status, save_campaign_entry,
-    save_post_stats, save_user_info, save_group_info
+    CampaignHistoryWriter, TaskLogWriter, db_read, db_write, db_write_nowait, save_task,
+    update_task_status, save_post_stats, save_user_info, save_group_info,
+    get_campaign_task_ids, reconcile_campaign_counters
 )
 
+# Сколько последних строк журнала задача держит в памяти; полный журнал — в task_logs
+LOG_RING_SIZE = 80
+
 
 @dataclass
 class TaskState:
@@ -23,15 +28,27 @@ class TaskState:
     sent: int = 0
     failed: int = 0
     total: int = 0
-    log: List[str] = field(default_factory=list)
+    streaming: bool = False
+    only_new: bool = False  # пропускать тех, кому под постом уже отвечали
+    # В потоковом режиме сбор и отправка идут одновременно
+    collect_stage: str = "pending"
+    send_stage: str = "pending"
+    total_estimated: bool = False
+    log: Deque[str] = field(default_factory=lambda: deque(maxlen=LOG_RING_SIZE))
+    log_seq: int = 0
+    log_writer: Optional[TaskLogWriter] = field(default=None, repr=False)
+    # Буфер истории и чекпоинт идущей рассылки — чтобы дописать их при остановке
+    history: Optional[CampaignHistoryWriter] = field(default=None, repr=False)
+    checkpoint: Optional["ProgressCheckpoint"] = field(default=None, repr=False)
 
     def add_log(self, text: str) -> None:
         self.log.append(text)
-        if len(self.log) > 80:
-            self.log = self.log[-80:]
+        self.log_seq += 1
+        if self.log_writer is not None:
+            self.log_writer.add(self.log_seq, text)
 
-    def snapshot(self) -> Dict[str, object]:
-        return {
+    def snapshot(self, with_log: bool = True) -> Dict[str, object]:
+        data: Dict[str, object] = {
             "id": self.id,
             "status": self.status,
             "promo_message": self.promo_message,
@@ -40,9 +57,58 @@ class TaskState:
             "sent": self.sent,
             "failed": self.failed,
             "total": self.total,
-            "log": self.log,
+            "total_estimated": self.total_estimated,
+            "streaming": self.streaming,
+            "only_new": self.only_new,
+            "stages": {"collect": self.collect_stage, "send": self.send_stage},
             "created_at": self.created_at,
         }
+        if with_log:
+            data["log"] = list(self.log)
+            data["log_seq"] = self.log_seq
+        return data
+
+
+class ProgressCheckpoint:
+    """
+    Сохраняет прогресс задачи в базу не на каждое событие, а раз в `interval`
+    секунд или каждые `every` событий; смена статуса пишется сразу.
+    TaskState в памяти при этом всегда актуален.
+    """
+
+    def __init__(self, state: TaskState, interval: float, every: int) -> None:
+        self.state = state
+        self.interval = interval
+        self.every = every
+        self.pending = 0
+        self.writes = 0
+        self._saved_status = state.status
+        self._timer: asyncio.TimerHandle | None = None
+
+    def event(self) -> None:
+        if self.state.status != self._saved_status:
+            self.save()
+            return
+        self.pending += 1
+        if self.pending >= self.every:
+            self.save()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.interval, self.save)
+
+    def save(self, **fields: object) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        state = self.state
+        # Журнал в строку задачи не пишется: он уходит в task_logs через TaskLogWriter
+        db_write_nowait(
+            update_task_status, state.id, state.status,
+            sent=state.sent, failed=state.failed,
+            total=state.total, **fields
+        )
+        self._saved_status = state.status
+        self.pending = 0
+        self.writes += 1
 
 
 class TaskManager:
@@ -52,43 +118,115 @@ class TaskManager:
     def get(self, task_id: str) -> TaskState | None:
         return self.tasks.get(task_id)
 
-    def create_campaign(self, cfg: BotConfig, post_ids: List[int], message: str) -> TaskState:
+    def create_campaign(
+        self,
+        cfg: BotConfig,
+        post_ids: List[int],
+        message: str,
+        streaming: bool | None = None,
+        only_new: bool = False,
+    ) -> TaskState:
         task_id = uuid.uuid4().hex[:8]
-        state = TaskState(id=task_id, post_ids=post_ids, promo_message=message)
+        state = TaskState(
+            id=task_id,
+            post_ids=post_ids,
+            promo_message=message,
+            streaming=cfg.streaming_campaign if streaming is None else streaming,
+            only_new=only_new,
+            log_writer=TaskLogWriter(task_id),
+        )
         self.tasks[task_id] = state
         
         # Сохраняем задачу в базу данных
-        save_task(state.snapshot())
+        db_write_nowait(save_task, state.snapshot(with_log=False))
         
         asyncio.create_task(self._run_campaign(state, cfg))
         return state
 
+    def is_active(self, task_id: str) -> bool:
+        state = self.tasks.get(task_id)
+        return state is not None and state.status not in ("completed", "failed")
+
+    async def reconcile_stats(self) -> int:
+        """
+        Сверяет счётчики рассылок с историей по задаче за раз, чтобы не держать
+        поток записи; идущие задачи пропускаются. Возвращает число исправленных.
+        """
+        fixed = 0
+        for task_id in await db_read(get_campaign_task_ids):
+            if self.is_active(task_id):
+                continue
+            if await db_write(reconcile_campaign_counters, task_id):
+                fixed += 1
+        return fixed
+
+    async def run_reconcile(self, interval_hours: float) -> None:
+        """Фоновая сверка счётчиков раз в interval_hours."""
+        while True:
+            await asyncio.sleep(interval_hours * 3600)
+            try:
+                await self.reconcile_stats()
+            except Exception:
+                pass  # Следующая сверка попробует снова
+
+    def flush(self) -> None:
+        """
+        Ставит в очередь записи буферы истории, журнала и прогресс всех идущих
+        рассылок — при остановке приложения, до shutdown_db.
+        """
+        for state in self.tasks.values():
+            if not self.is_active(state.id):
+                continue
+            if state.history is not None:
+                state.history.flush()
+            if state.log_writer is not None:
+                state.log_writer.flush()
+            if state.checkpoint is not None:
+                state.checkpoint.save()
+
     async def _run_campaign(self, state: TaskState, cfg: BotConfig) -> None:
-        client = VKService(cfg)
+        client = clients.acquire(cfg)
         state.status = "collecting"
+        state.collect_stage = "running"
         state.add_log("Старт задачи, читаю комментарии выбранных постов...")
+        history = CampaignHistoryWriter(state.id, client.community.group_id)
+        checkpoint = ProgressCheckpoint(state, cfg.progress_save_interval, cfg.progress_save_every)
+        state.history, state.checkpoint = history, checkpoint
 
         def on_progress(event: Dict[str, object]) -> None:
             stage = event.get("stage")
             if event.get("log"):
                 state.add_log(str(event["log"]))
 
-            if stage == "collect":
-                state.status = "collecting"
-                update_task_status(state.id, "collecting", log=state.log)
-            if stage == "collect_done":
-                state.status = "collecting"
-                update_task_status(state.id, "collecting", log=state.log)
+            if stage in ("collect", "collect_done"):
+                state.collect_stage = "running"
+                if state.send_stage == "running":
+                    # Потоковый режим: отправка уже идёт, оценка total уточняется
+                    if "total" in event:
+                        state.total = int(event.get("total", state.total))
+                else:
+                    state.status = "collecting"
+                checkpoint.event()
+            if stage == "collect_finished":
+                state.collect_stage = "done"
+                state.total_estimated = False
+                state.total = int(event.get("total", state.total))
+                checkpoint.save()
             if stage == "sending":
                 state.status = "sending"
+                state.send_stage = "running"
+                state.total_estimated = bool(event.get("estimated", False))
+                if not state.total_estimated:
+                    state.collect_stage = "done"
                 state.total = int(event.get("total", 0))
-                update_task_status(state.id, "sending", total=state.total, log=state.log)
+                checkpoint.save()
             if stage == "progress":
                 state.status = "sending"
                 prev_sent = state.sent
                 state.sent = int(event.get("sent", state.sent))
                 state.failed = int(event.get("failed", state.failed))
                 state.total = int(event.get("total", state.total))
+                state.total_estimated = bool(event.get("estimated", False))
                 
                 # Сохраняем запись о попытке отправки
                 user_id = event.get("user_id")
@@ -97,33 +235,28 @@ class TaskManager:
                 if user_id and post_id:
                     # Определяем статус отправки
                     send_status = "sent" if state.sent > prev_sent else "failed"
-                    save_campaign_entry(
-                        state.id, int(user_id), int(post_id), 
-                        int(comment_id) if comment_id else 0, send_status
+                    history.add(
+                        int(user_id), int(post_id),
+                        int(comment_id) if comment_id else 0, send_status,
+                        event.get("error") if send_status == "failed" else None
                     )
                 
-                # Обновляем задачу в БД
-                update_task_status(
-                    state.id, state.status,
-                    sent=state.sent, failed=state.failed, 
-                    total=state.total, log=state.log
-                )
+                # В базу — пачкой, см. ProgressCheckpoint
+                checkpoint.event()
             if stage == "error":
                 state.status = "failed"
-                update_task_status(state.id, "failed", error=str(event.get("log", "")), log=state.log)
+                checkpoint.save(error=str(event.get("log", "")))
             if stage == "completed":
+                history.flush()
                 state.status = "completed"
+                state.collect_stage = state.send_stage = "done"
+                state.total_estimated = False
                 state.sent = int(event.get("sent", state.sent))
                 state.failed = int(event.get("failed", state.failed))
                 state.total = int(event.get("total", state.total))
                 
                 # Обновляем задачу в БД
-                update_task_status(
-                    state.id, "completed",
-                    completed_at=datetime.utcnow().isoformat(),
-                    sent=state.sent, failed=state.failed, 
-                    total=state.total, log=state.log
-                )
+                checkpoint.save(completed_at=datetime.utcnow().isoformat())
 
         try:
             # Сохраняем статистику постов перед началом
@@ -131,8 +264,8 @@ class TaskManager:
                 try:
                     post_details = await client.get_post_details(post_id)
                     if post_details:
-                        save_post_stats(
-                            cfg.group_id, post_id,
+                        db_write_nowait(
+                            save_post_stats, cfg.group_id, post_id,
                             {
                                 "views": post_details.get("views", 0),
                                 "likes": post_details.get("likes", 0),
@@ -144,31 +277,41 @@ class TaskManager:
                     pass  # Игнорируем ошибки при сохранении статистики
             
             result = await client.send_campaign(
-                state.post_ids, state.promo_message, on_progress=on_progress
+                state.post_ids, state.promo_message,
+                on_progress=on_progress, streaming=state.streaming, only_new=state.only_new
             )
             state.status = "completed"
+            state.collect_stage = state.send_stage = "done"
+            state.total_estimated = False
             state.sent = result["sent"]
             state.failed = result["failed"]
             state.total = result["total"]
             state.add_log("Задача завершена.")
             
             # Финальное обновление в БД
-            update_task_status(
-                state.id, "completed",
-                completed_at=datetime.utcnow().isoformat(),
-                sent=state.sent, failed=state.failed, 
-                total=state.total, log=state.log
-            )
+            checkpoint.save(completed_at=datetime.utcnow().isoformat())
+        except asyncio.CancelledError:
+            # Сервер остановился посреди рассылки: фиксируем, докуда она дошла
+            state.status = "failed"
+            state.error = "Задача прервана остановкой приложения"
+            state.add_log(state.error)
+            checkpoint.save(error=state.error)
+            raise
         except Exception as exc:
             state.status = "failed"
+            if state.collect_stage == "running":
+                state.collect_stage = "failed"
+            if state.send_stage == "running":
+                state.send_stage = "failed"
             state.error = f"Ошибка: {exc}"
             state.add_log(state.error)
-            update_task_status(
-                state.id, "failed",
-                error=state.error, log=state.log
-            )
+            checkpoint.save(error=state.error)
         finally:
-            await client.close()
+            # Дописываем хвост истории и журнала и при ошибке задачи
+            history.flush()
+            if state.log_writer is not None:
+                state.log_writer.flush()
+            await clients.release(client)
 
 
 tasks = TaskManager()
@@ -1,14 +1,30 @@
 import asyncio
-from datetime import datetime
-from typing import Callable, Dict, Iterable, List, Tuple
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Iterable, List, Set, Tuple, TypeVar
 
-from vkbottle import API
 from vkbottle.exception_factory import VKAPIError
+from vkbottle.http import AiohttpClient
 
-from storage import BotConfig, get_active_community
-from database import save_user_info
+from cache import make_params, response_cache
+from ratelimit import GROUP_TOKEN_RPS, USER_TOKEN_RPS, LimitedAPI
+from storage import BotConfig, Community, get_active_community, on_config_saved
+from database import (
+    db_read, db_write, get_comment_cache, get_fresh_user_ids, get_replied_user_ids,
+    save_comment_cache, save_users_info
+)
 
 ProgressHandler = Callable[[Dict[str, object]], None]
+T = TypeVar("T")
+
+COMMENTS_PAGE_SIZE = 100
+# VK разрешает не больше 25 вызовов API внутри одного execute
+EXECUTE_MAX_CALLS = 25
+# users.get принимает до 1000 id за вызов
+USERS_GET_BATCH = 1000
+# Профили, обновлённые позже этого срока, повторно не запрашиваются
+USER_INFO_TTL = timedelta(hours=24)
 
 
 def _safe_text_preview(text: str, limit: int = 80) -> str:
@@ -16,22 +32,294 @@ def _safe_text_preview(text: str, limit: int = 80) -> str:
     return clean if len(clean) <= limit else f"{clean[:limit].rstrip()}…"
 
 
+def build_comments_execute_code(
+    owner_id: int,
+    post_id: int,
+    offset: int,
+    pages: int = EXECUTE_MAX_CALLS,
+    start_comment_id: int | None = None,
+) -> str:
+    """
+    VKScript для execute: читает до `pages` страниц wall.getComments подряд,
+    начиная с `offset` (от комментария `start_comment_id`, если он задан),
+    и возвращает только from_id/id каждого комментария.
+    Цикл останавливается на первой неполной странице.
+    """
+    start = f'"start_comment_id": {int(start_comment_id)},' if start_comment_id else ""
+    return f"""
+var offset = {int(offset)};
+var pages = [];
+var i = 0;
+while (i < {int(pages)}) {{
+    var resp = API.wall.getComments({{
+        "owner_id": {int(owner_id)},
+        "post_id": {int(post_id)},
+        "offset": offset + i * {COMMENTS_PAGE_SIZE},
+        "count": {COMMENTS_PAGE_SIZE},{start}
+        "extended": 0
+    }});
+    if (!resp) {{
+        return {{"pages": pages}};
+    }}
+    pages.push({{"count": resp.count, "from_ids": resp.items@.from_id, "ids": resp.items@.id}});
+    if (resp.items.length < {COMMENTS_PAGE_SIZE}) {{
+        i = {int(pages)};
+    }} else {{
+        i = i + 1;
+    }}
+}}
+return {{"pages": pages}};
+""".strip()
+
+
+def build_comments_since_execute_code(
+    owner_id: int, post_id: int, since_id: int, offset: int, pages: int = EXECUTE_MAX_CALLS
+) -> str:
+    """
+    VKScript для execute: листает комментарии от новых к старым страницами
+    по 100, начиная с `offset`, пока не дойдёт до комментария `since_id` (или
+    более старого), неполной страницы или `pages` страниц. Возвращает id всех
+    прочитанных комментариев и признак, что since_id достигнут.
+    """
+    return f"""
+var offset = {int(offset)};
+var ids = [];
+var i = 0;
+var done = false;
+while (i < {int(pages)}) {{
+    var resp = API.wall.getComments({{
+        "owner_id": {int(owner_id)},
+        "post_id": {int(post_id)},
+        "offset": offset + i * {COMMENTS_PAGE_SIZE},
+        "count": {COMMENTS_PAGE_SIZE},
+        "sort": "desc",
+        "extended": 0
+    }});
+    if (!resp) {{
+        return {{"ids": ids, "pages": i, "done": false}};
+    }}
+    ids = ids + resp.items@.id;
+    i = i + 1;
+    if (resp.items.length < {COMMENTS_PAGE_SIZE}) {{
+        done = true;
+    }} else {{
+        if (resp.items[resp.items.length - 1].id <= {int(since_id)}) {{
+            done = true;
+        }}
+    }}
+    if (done) {{
+        return {{"ids": ids, "pages": i, "done": true}};
+    }}
+}}
+return {{"ids": ids, "pages": i, "done": false}};
+""".strip()
+
+
+def build_latest_comments_execute_code(
+    owner_id: int, post_ids: List[int], count: int
+) -> str:
+    """
+    VKScript для execute: свежие комментарии сразу нескольких постов (до 25).
+    Для каждого поста возвращает массив id (новые первыми) или false, если
+    пост недоступен.
+    """
+    lines = ["var result = [];", "var resp;"]
+    for post_id in post_ids:
+        params = (
+            f'{{"owner_id": {int(owner_id)}, "post_id": {int(post_id)}, '
+            f'"count": {int(count)}, "sort": "desc", "extended": 0}}'
+        )
+        lines.append(f"resp = API.wall.getComments({params});")
+        lines.append("if (resp) { result.push(resp.items@.id); } else { result.push(false); }")
+    lines.append("return result;")
+    return "\n".join(lines)
+
+
+async def _gather_or_cancel(*aws: Awaitable[T]) -> List[T]:
+    """
+    Как asyncio.gather, но при ошибке одной корутины отменяет и дожидается
+    остальных: сбор упавшей рассылки не продолжает читать посты в фоне.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return list(await asyncio.gather(*tasks))
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+def encode_posts_cursor(offset: int, before_id: int) -> str:
+    return f"{offset}:{before_id}"
+
+
+def decode_posts_cursor(cursor: str) -> Tuple[int, int]:
+    try:
+        offset, before_id = (int(part) for part in cursor.split(":", 1))
+    except ValueError as exc:
+        raise ValueError(f"Некорректный курсор: {cursor}") from exc
+    if offset < 0 or before_id < 0:
+        raise ValueError(f"Некорректный курсор: {cursor}")
+    return offset, before_id
+
+
+class ReplySender:
+    """
+    Окно одновременных wall.createComment: держит до `window` ответов в полёте,
+    а темп задаёт лимитер токена сообщества. Результаты разбираются в порядке
+    постановки, поэтому события прогресса и счётчики sent/failed остаются точными.
+    """
+
+    def __init__(
+        self,
+        service: "VKService",
+        message: str,
+        window: int,
+        on_progress: ProgressHandler | None = None,
+        total: int = 0,
+    ) -> None:
+        self.service = service
+        self.message = message
+        self.window = max(1, window)
+        self.on_progress = on_progress
+        self.total = total
+        # True, пока total — оценка (потоковый режим, сбор ещё идёт)
+        self.estimated = False
+        self.current = 0
+        self.sent = 0
+        self.failed = 0
+        self._pending: Deque[Tuple["asyncio.Task[str | None]", int, int, int]] = deque()
+
+    async def submit(self, user_id: int, post_id: int, comment_id: int) -> None:
+        while len(self._pending) >= self.window:
+            await self._complete_next()
+        task = asyncio.create_task(
+            self.service.reply_with_error(post_id, comment_id, self.message)
+        )
+        self._pending.append((task, user_id, post_id, comment_id))
+
+    async def drain(self) -> None:
+        while self._pending:
+            await self._complete_next()
+
+    def cancel(self) -> None:
+        while self._pending:
+            task, *_ = self._pending.popleft()
+            task.cancel()
+
+    async def _complete_next(self) -> None:
+        task, user_id, post_id, comment_id = self._pending[0]
+        error = await task
+        self._pending.popleft()
+        self.current += 1
+        if error is None:
+            self.sent += 1
+        else:
+            self.failed += 1
+
+        if self.on_progress:
+            self.on_progress(
+                {
+                    "stage": "progress",
+                    "current": self.current,
+                    "total": self.total,
+                    "estimated": self.estimated,
+                    "sent": self.sent,
+                    "failed": self.failed,
+                    "user_id": user_id,
+                    "post_id": post_id,
+                    "comment_id": comment_id,
+                    "error": error,
+                }
+            )
+
+
+class UserEnricher:
+    """
+    Фоновая догрузка профилей участников рядом с рассылкой: id копятся до полной
+    пачки users.get (1000), пользователи со свежей записью в users пропускаются
+    (проверка идёт в пуле чтения базы), а каждая пачка сохраняется одним запросом.
+    """
+
+    def __init__(self, service: "VKService") -> None:
+        self.service = service
+        self._pending: List[int] = []
+        self._tasks: List["asyncio.Task[None]"] = []
+
+    def add(self, user_ids: List[int]) -> None:
+        if not user_ids:
+            return
+        self._pending.extend(user_ids)
+        while len(self._pending) >= USERS_GET_BATCH:
+            self._spawn(self._pending[:USERS_GET_BATCH])
+            self._pending = self._pending[USERS_GET_BATCH:]
+
+    def flush(self) -> None:
+        """Отправляет неполную последнюю пачку."""
+        if self._pending:
+            self._spawn(self._pending)
+            self._pending = []
+
+    async def wait(self) -> None:
+        await asyncio.gather(*self._tasks)
+
+    def cancel(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+
+    def _spawn(self, batch: List[int]) -> None:
+        self._tasks.append(asyncio.create_task(self._enrich(batch)))
+
+    async def _enrich(self, batch: List[int]) -> None:
+        # Профили — необязательное дополнение: ни ошибка VK, ни ошибка базы
+        # (например, "database is locked") не должны ронять рассылку
+        try:
+            fresh = await db_read(get_fresh_user_ids, batch, datetime.utcnow() - USER_INFO_TTL)
+            batch = [u for u in batch if u not in fresh]
+            if not batch:
+                return
+            users_info = await self.service.get_users_info(batch)
+            await db_write(save_users_info, users_info)
+        except Exception:
+            return  # Игнорируем ошибки при получении информации о пользователях
+
+
 class VKService:
     def __init__(self, cfg: BotConfig) -> None:
         self.cfg = cfg
         community = get_active_community(cfg)
         if not community:
             raise RuntimeError("Не выбрано сообщество")
+        self.community = community
         self.owner_id = -abs(community.group_id)
-        self.user_api = API(community.user_token)
-        self.group_api = API(community.group_token)
+        # Своя keep-alive сессия на клиента: общий SingleAiohttpClient vkbottle
+        # пересоздаётся с каждым API и закрывался бы у всех при close()
+        self.http_client = AiohttpClient()
+        # Темп запросов задают общие для процесса лимитеры токенов
+        self.user_api = LimitedAPI(
+            community.user_token, USER_TOKEN_RPS, http_client=self.http_client
+        )
+        self.group_api = LimitedAPI(
+            community.group_token, GROUP_TOKEN_RPS, http_client=self.http_client
+        )
+
+    async def fetch_posts(
+        self, limit: int = 20, offset: int = 0, use_cache: bool = True
+    ) -> List[Dict[str, object]]:
+        params = make_params(count=limit, offset=offset)
+        if use_cache:
+            cached = response_cache.get(self.community.group_id, "wall.get", params)
+            if cached is not None:
+                return cached
 
-    async def fetch_posts(self, limit: int = 20) -> List[Dict[str, object]]:
         try:
             resp = await self.user_api.request(
                 "wall.get", {
                     "owner_id": self.owner_id, 
                     "count": limit,
+                    "offset": offset,
                     "extended": 1  # Получаем расширенную информацию
                 }
             )
@@ -66,10 +354,60 @@ class VKService:
                     "has_photo": has_photo,
                     "has_video": has_video,
                     "attachments_count": len(attachments),
+                    "is_pinned": bool(item.get("is_pinned")),
                 }
             )
+        response_cache.set(self.community.group_id, "wall.get", params, posts)
         return posts
 
+    async def fetch_posts_page(
+        self, limit: int = 20, cursor: str | None = None
+    ) -> Dict[str, object]:
+        """
+        Страница ленты по курсору. Курсор хранит offset следующей страницы и
+        наименьший уже отданный id: если за это время вышли новые посты и ленту
+        сдвинуло, повторно попавшие на страницу посты отбрасываются.
+        """
+        offset, before_id = decode_posts_cursor(cursor) if cursor else (0, 0)
+        posts = await self.fetch_posts(limit=limit, offset=offset)
+
+        items = [
+            p for p in posts
+            if not before_id or (not p["is_pinned"] and int(p["id"]) < before_id)
+        ]
+        regular_ids = [int(p["id"]) for p in posts if not p["is_pinned"]]
+        lowest = min(regular_ids + ([before_id] if before_id else []), default=0)
+        next_cursor = (
+            encode_posts_cursor(offset + len(posts), lowest) if len(posts) >= limit else None
+        )
+        return {"items": items, "next_cursor": next_cursor}
+
+    async def fetch_new_posts(
+        self, since_id: int, page_size: int = 20, max_pages: int = 25
+    ) -> List[Dict[str, object]]:
+        """
+        Инкрементальное обновление: листает ленту с начала, пока не дойдёт до поста
+        с id <= since_id, и возвращает только более новые посты (новые сверху).
+        """
+        new_posts: List[Dict[str, object]] = []
+        offset = 0
+        for _ in range(max_pages):
+            posts = await self.fetch_posts(limit=page_size, offset=offset, use_cache=False)
+            reached = False
+            for post in posts:
+                if int(post["id"]) > since_id:
+                    new_posts.append(post)
+                elif not post["is_pinned"]:
+                    reached = True
+            if reached or len(posts) < page_size:
+                break
+            offset += len(posts)
+
+        if new_posts:
+            # Закэшированные страницы ленты сдвинулись
+            response_cache.invalidate(self.community.group_id, method="wall.get")
+        return new_posts
+
     async def get_group_info(self) -> Dict[str, object]:
         """Получает информацию о группе."""
         try:
@@ -101,6 +439,11 @@ class VKService:
 
     async def get_post_details(self, post_id: int) -> Dict[str, object]:
         """Получает детальную информацию о посте."""
+        params = make_params(post_id=post_id)
+        cached = response_cache.get(self.community.group_id, "wall.getById", params)
+        if cached is not None:
+            return cached
+
         try:
             resp = await self.user_api.request(
                 "wall.getById", {
@@ -121,7 +464,7 @@ class VKService:
         views = item.get("views", {})
         views_count = views.get("count", 0) if isinstance(views, dict) else 0
         
-        return {
+        details = {
             "id": item.get("id"),
             "text": item.get("text", ""),
             "date": datetime.fromtimestamp(item.get("date", 0)).isoformat()
@@ -132,6 +475,8 @@ class VKService:
             "views": views_count,
             "attachments": item.get("attachments", []),
         }
+        response_cache.set(self.community.group_id, "wall.getById", params, details)
+        return details
 
     async def get_users_info(self, user_ids: List[int]) -> List[Dict[str, object]]:
         """Получает информацию о пользователях."""
@@ -142,7 +487,7 @@ class VKService:
             # VK API позволяет запрашивать до 1000 пользователей за раз
             resp = await self.user_api.request(
                 "users.get", {
-                    "user_ids": ",".join(map(str, user_ids[:1000])),
+                    "user_ids": ",".join(map(str, user_ids[:USERS_GET_BATCH])),
                     "fields": "photo_100,last_seen"
                 }
             )
@@ -172,93 +517,241 @@ class VKService:
     async def get_unique_commentators(
         self, post_id: int, on_progress: ProgressHandler | None = None
     ) -> List[Tuple[int, int]]:
-        offset = 0
-        count = 100
         user_to_comment: Dict[int, int] = {}
+        loaded = 0
 
-        while True:
-            try:
-                resp = await self.user_api.request(
-                    "wall.getComments",
-                    {
-                        "owner_id": self.owner_id,
-                        "post_id": post_id,
-                        "offset": offset,
-                        "count": count,
-                        "extended": 0,
-                    },
-                )
-            except VKAPIError as exc:
-                if on_progress:
-                    on_progress(
-                        {
-                            "stage": "error",
-                            "log": f"VK API error while reading comments on post {post_id}: {exc}",
-                        }
-                    )
-                break
-
-            payload = resp.get("response", resp) if isinstance(resp, dict) else {}
-            items = payload.get("items") if isinstance(payload, dict) else []
-            if not items:
-                break
-
-            for comment in items:
-                user_id = comment.get("from_id")
-                comment_id = comment.get("id")
+        async for _, page in self._iter_commentator_pages(post_id, on_progress=on_progress):
+            for user_id, comment_id in page:
                 if user_id and user_id > 0 and comment_id is not None:
                     user_to_comment[user_id] = comment_id
+            loaded += len(page)
 
             if on_progress:
                 on_progress(
                     {
                         "stage": "collect",
                         "post_id": post_id,
-                        "loaded": offset + len(items),
+                        "loaded": loaded,
                         "unique": len(user_to_comment),
                     }
                 )
 
-            if len(items) < count:
-                break
+        return list(user_to_comment.items())
 
-            offset += count
-            await asyncio.sleep(self.cfg.request_delay)
+    async def _iter_commentator_pages(
+        self, post_id: int, on_progress: ProgressHandler | None = None
+    ) -> AsyncIterator[Tuple[int, List[Tuple[int, int]]]]:
+        """
+        Комментарии поста для сбора участников, через кэш сбора. Если пост уже
+        читали, сначала отдаются сохранённые участники — первый и последний
+        комментарий каждого в порядке id, что для обоих режимов рассылки равно
+        полному чтению, — затем дочитываются только комментарии новее курсора.
+        Раз в comment_cache_ttl_hours пост читается целиком.
+        """
+        ttl = self.cfg.comment_cache_ttl_hours
+        group_id = self.community.group_id
+        cache = await db_read(get_comment_cache, group_id, post_id) if ttl else None
+        if cache and datetime.fromisoformat(cache["full_read_at"]) < datetime.utcnow() - timedelta(hours=ttl):
+            cache = None
 
-        return list(user_to_comment.items())
+        authors: Dict[int, List[int]] = {}
+        max_id = 0
+        comments = 0
 
-    async def fetch_comments(self, post_id: int, limit: int = 30) -> List[Dict[str, object]]:
-        try:
-            resp = await self.user_api.request(
-                "wall.getComments",
-                {
-                    "owner_id": self.owner_id,
-                    "post_id": post_id,
-                    "offset": 0,
-                    "count": limit,
-                    "sort": "desc",
-                },
+        def track(page: List[Tuple[int, int]]) -> None:
+            nonlocal max_id, comments
+            for user_id, comment_id in page:
+                if comment_id is None:
+                    continue
+                comments += 1
+                max_id = max(max_id, comment_id)
+                if not user_id or user_id <= 0:
+                    continue
+                ids = authors.get(user_id)
+                if ids is None:
+                    authors[user_id] = [comment_id, comment_id]
+                else:
+                    ids[0] = min(ids[0], comment_id)
+                    ids[1] = max(ids[1], comment_id)
+
+        if cache:
+            since = int(cache["max_comment_id"])
+            replay = sorted(
+                {(cid, user_id) for user_id, first, last in cache["authors"] for cid in (first, last)}
             )
+            stream = [(user_id, cid) for cid, user_id in replay]
+            # Новых комментариев немного: дочитываем их до отдачи кэша, чтобы
+            # при ошибке перейти к полному чтению, ничего не отдав
+            fresh_pages: List[Tuple[int, List[Tuple[int, int]]]] = []
+            try:
+                async for count, page in self._iter_comment_pages(post_id, start_comment_id=since):
+                    fresh = [(u, c) for u, c in page if c is not None and c > since]
+                    track(fresh)
+                    if fresh:
+                        fresh_pages.append((count, fresh))
+            except VKAPIError:
+                # Курсор мог указывать на удалённый комментарий — читаем пост целиком
+                authors.clear()
+                max_id = comments = 0
+            else:
+                for i in range(0, len(stream), COMMENTS_PAGE_SIZE):
+                    yield int(cache["comments"]), stream[i:i + COMMENTS_PAGE_SIZE]
+                for item in fresh_pages:
+                    yield item
+                await db_write(
+                    save_comment_cache, group_id, post_id, max(max_id, since),
+                    int(cache["comments"]) + comments,
+                    [(u, first, last) for u, (first, last) in authors.items()],
+                )
+                return
+
+        try:
+            async for count, page in self._iter_comment_pages(post_id):
+                if ttl:
+                    track(page)
+                yield count, page
         except VKAPIError as exc:
-            raise RuntimeError(f"VK API error while loading comments: {exc}") from exc
+            # Неполное чтение в кэш не попадает
+            if on_progress:
+                on_progress(
+                    {
+                        "stage": "error",
+                        "log": f"VK API error while reading comments on post {post_id}: {exc}",
+                    }
+                )
+            return
 
-        payload = resp.get("response", resp) if isinstance(resp, dict) else {}
-        items = payload.get("items") if isinstance(payload, dict) else []
-        result: List[Dict[str, object]] = []
-        for c in items or []:
-            result.append({"id": c.get("id"), "from_id": c.get("from_id")})
+        if ttl:
+            await db_write(
+                save_comment_cache, group_id, post_id, max_id, comments,
+                [(u, first, last) for u, (first, last) in authors.items()],
+                full_read=True,
+            )
+
+    async def _iter_comment_pages(
+        self, post_id: int, start_comment_id: int | None = None
+    ) -> AsyncIterator[Tuple[int, List[Tuple[int, int]]]]:
+        """
+        Отдаёт комментарии поста постранично: (count, [(from_id, comment_id), ...]),
+        с начала или от комментария start_comment_id. В режиме execute за один
+        запрос читается до 25 страниц; если execute недоступен, чтение
+        продолжается обычными wall.getComments с того же offset. Ошибка VK API
+        пробрасывается.
+        """
+        offset = 0
+
+        if self.cfg.collect_via_execute:
+            while True:
+                try:
+                    pages = await self._fetch_comment_pages_execute(post_id, offset, start_comment_id)
+                except VKAPIError:
+                    break
+
+                done = False
+                for count, page in pages:
+                    if not page:
+                        done = True
+                        break
+                    yield count, page
+                    offset += len(page)
+                    if len(page) < COMMENTS_PAGE_SIZE:
+                        done = True
+                        break
+                if done:
+                    return
+                if len(pages) < EXECUTE_MAX_CALLS:
+                    # execute оборвался на ошибке вложенного вызова — дочитываем постранично
+                    break
+
+        params: Dict[str, object] = {"owner_id": self.owner_id, "post_id": post_id, "extended": 0}
+        if start_comment_id:
+            params["start_comment_id"] = start_comment_id
+        while True:
+            payload = await self.user_api.request_fast(
+                "wall.getComments", {**params, "offset": offset, "count": COMMENTS_PAGE_SIZE}
+            )
+
+            items = payload.get("items") if isinstance(payload, dict) else []
+            if not items:
+                return
+
+            count = int(payload.get("count") or 0)
+            yield count, [(c.get("from_id"), c.get("id")) for c in items]
+
+            if len(items) < COMMENTS_PAGE_SIZE:
+                return
+
+            offset += COMMENTS_PAGE_SIZE
+
+    async def _fetch_comment_pages_execute(
+        self, post_id: int, offset: int, start_comment_id: int | None = None
+    ) -> List[Tuple[int, List[Tuple[int, int]]]]:
+        code = build_comments_execute_code(
+            self.owner_id, post_id, offset, start_comment_id=start_comment_id
+        )
+        payload = await self.user_api.request_fast("execute", {"code": code})
+        raw_pages = payload.get("pages") if isinstance(payload, dict) else []
+
+        pages: List[Tuple[int, List[Tuple[int, int]]]] = []
+        for raw in raw_pages or []:
+            from_ids = raw.get("from_ids") or []
+            ids = raw.get("ids") or []
+            pages.append((int(raw.get("count") or 0), list(zip(from_ids, ids))))
+        return pages
+
+    async def fetch_latest_comment_ids(
+        self, post_ids: List[int], limit: int = 30
+    ) -> Dict[int, List[int] | None]:
+        """
+        Id свежих комментариев нескольких постов одним вызовом execute на каждые
+        25 постов. None — пост прочитать не удалось.
+        """
+        result: Dict[int, List[int] | None] = {}
+        for i in range(0, len(post_ids), EXECUTE_MAX_CALLS):
+            chunk = post_ids[i:i + EXECUTE_MAX_CALLS]
+            code = build_latest_comments_execute_code(self.owner_id, chunk, limit)
+            try:
+                payload = await self.user_api.request_fast("execute", {"code": code})
+            except VKAPIError as exc:
+                raise RuntimeError(f"VK API error while loading comments: {exc}") from exc
+            for post_id, ids in zip(chunk, payload or []):
+                result[post_id] = list(ids) if isinstance(ids, list) else None
         return result
 
+    async def fetch_comment_ids_since(
+        self, post_id: int, since_id: int, offset: int = 0
+    ) -> Tuple[List[int], int | None]:
+        """
+        Один шаг догоняющего чтения: до 25 страниц комментариев новее since_id
+        за вызов execute, от новых к старым. Возвращает их id и offset для
+        следующего шага (None — since_id достигнут).
+        """
+        code = build_comments_since_execute_code(self.owner_id, post_id, since_id, offset)
+        try:
+            payload = await self.user_api.request_fast("execute", {"code": code})
+        except VKAPIError as exc:
+            raise RuntimeError(f"VK API error while loading comments: {exc}") from exc
+        payload = payload if isinstance(payload, dict) else {}
+        ids = [int(cid) for cid in payload.get("ids") or [] if int(cid) > since_id]
+        if payload.get("done"):
+            return ids, None
+        pages = int(payload.get("pages") or 0)
+        if not pages:
+            raise RuntimeError("VK API error while loading comments: пустой ответ execute")
+        return ids, offset + pages * COMMENTS_PAGE_SIZE
+
     async def close(self) -> None:
-        """Закрываем HTTP-сессии vkBottle, чтобы не было утечек."""
-        for api in (self.user_api, self.group_api):
-            if hasattr(api, "http_client") and hasattr(api.http_client, "close"):
-                try:
-                    await api.http_client.close()  # type: ignore[attr-defined]
-                except Exception:
-                    pass
+        """Закрываем HTTP-сессию клиента, чтобы не было утечек."""
+        try:
+            await self.http_client.close()
+        except Exception:
+            pass
 
     async def reply_to_comment(self, post_id: int, comment_id: int, message: str) -> bool:
+        return await self.reply_with_error(post_id, comment_id, message) is None
+
+    async def reply_with_error(self, post_id: int, comment_id: int, message: str) -> str | None:
+        """Отвечает на комментарий; возвращает класс ошибки ("vk_15", "timeout"...) или None."""
         try:
             await self.group_api.wall.create_comment(
                 owner_id=self.owner_id,
@@ -266,82 +759,354 @@ class VKService:
                 reply_to_comment=comment_id,
                 message=message,
             )
-            return True
-        except VKAPIError:
-            return False
-        except Exception:
-            return False
+            return None
+        except VKAPIError as exc:
+            return f"vk_{exc.code}"
+        except asyncio.TimeoutError:
+            return "timeout"
+        except Exception as exc:
+            return type(exc).__name__
 
     async def send_campaign(
         self,
         post_ids: Iterable[int],
         message: str,
         on_progress: ProgressHandler | None = None,
+        streaming: bool | None = None,
+        only_new: bool = False,
     ) -> Dict[str, int]:
-        all_commentators: Dict[int, Tuple[int, int]] = {}
+        """
+        Отвечает всем участникам постов. С only_new пропускаются те, кому под
+        этим постом уже отвечали прошлые рассылки (по reply_ledger).
+        """
+        if streaming is None:
+            streaming = self.cfg.streaming_campaign
+        if streaming:
+            return await self._send_campaign_streaming(post_ids, message, on_progress, only_new)
 
-        for post_id in post_ids:
-            if on_progress:
-                on_progress({"stage": "collect", "log": f"Читаю комментарии поста {post_id}..."})
+        posts = list(post_ids)
+        semaphore = asyncio.Semaphore(self.cfg.collect_concurrency)
+
+        async def collect(post_id: int) -> List[Tuple[int, int]]:
+            async with semaphore:
+                if on_progress:
+                    on_progress({"stage": "collect", "log": f"Читаю комментарии поста {post_id}..."})
+                return await self.get_unique_commentators(post_id, on_progress=on_progress)
 
-            commentators = await self.get_unique_commentators(post_id, on_progress=on_progress)
+        # Посты читаются параллельно, а сливаются в порядке post_ids
+        results = await _gather_or_cancel(*(collect(post_id) for post_id in posts))
 
+        all_commentators: Dict[int, Tuple[int, int]] = {}
+        # Кому уже отвечали под постом, где они встретились первыми: такой
+        # участник занят этим постом и не получает ответ под следующими
+        claimed: Set[int] = set()
+        for post_id, commentators in zip(posts, results):
+            replied = await self._replied_users(post_id, commentators) if only_new else set()
             for user_id, comment_id in commentators:
-                if user_id not in all_commentators:
-                    all_commentators[user_id] = (post_id, comment_id)
+                if user_id in all_commentators or user_id in claimed:
+                    continue
+                if user_id in replied:
+                    claimed.add(user_id)
+                    continue
+                all_commentators[user_id] = (post_id, comment_id)
 
             if on_progress:
+                log = f"Пост {post_id}: найдено участников {len(commentators)}"
+                if only_new:
+                    log += f", новых {len(commentators) - len(replied)}"
                 on_progress(
                     {
                         "stage": "collect_done",
-                        "log": f"Пост {post_id}: найдено участников {len(commentators)}",
+                        "log": log,
                         "unique_total": len(all_commentators),
                     }
                 )
 
         total = len(all_commentators)
-        sent = 0
-        failed = 0
 
         if on_progress:
             on_progress({"stage": "sending", "total": total})
 
-        # Получаем информацию о пользователях батчами
-        user_ids_list = list(all_commentators.keys())
-        for i in range(0, len(user_ids_list), 100):
-            batch = user_ids_list[i:i+100]
-            try:
-                users_info = await self.get_users_info(batch)
-                # Сохраняем информацию о пользователях
-                for user_info in users_info:
-                    save_user_info(user_info["id"], user_info)
-            except Exception:
-                pass  # Игнорируем ошибки при получении информации о пользователях
-        
-        for idx, (user_id, (post_id, comment_id)) in enumerate(all_commentators.items(), start=1):
-            ok = await self.reply_to_comment(post_id, comment_id, message)
-            if ok:
-                sent += 1
+        # Профили догружаются в фоне, не задерживая первый ответ
+        enricher = UserEnricher(self)
+        enricher.add(list(all_commentators.keys()))
+        enricher.flush()
+
+        sender = ReplySender(
+            self, message, self.community.send_concurrency, on_progress=on_progress, total=total
+        )
+        try:
+            for user_id, (post_id, comment_id) in all_commentators.items():
+                await sender.submit(user_id, post_id, comment_id)
+            await sender.drain()
+            await enricher.wait()
+        finally:
+            sender.cancel()
+            enricher.cancel()
+        sent, failed = sender.sent, sender.failed
+        # Ответы изменили счётчики комментариев постов
+        response_cache.invalidate(self.community.group_id)
+
+        if on_progress:
+            on_progress({"stage": "completed", "sent": sent, "failed": failed, "total": total})
+
+        return {"sent": sent, "failed": failed, "total": total}
+
+    async def _replied_users(
+        self, post_id: int, commentators: List[Tuple[int, int]]
+    ) -> Set[int]:
+        """Участники, которым под этим постом уже отвечали; одна выборка на пачку."""
+        if not commentators:
+            return set()
+        return await db_read(
+            get_replied_user_ids, self.community.group_id, post_id, [u for u, _ in commentators]
+        )
+
+    async def _send_campaign_streaming(
+        self,
+        post_ids: Iterable[int],
+        message: str,
+        on_progress: ProgressHandler | None = None,
+        only_new: bool = False,
+    ) -> Dict[str, int]:
+        """
+        Потоковая рассылка: каждая прочитанная страница комментариев сразу уходит
+        в очередь ответов. Пересечения между постами проверяются по мере поступления,
+        поэтому пользователь получает ответ на первый найденный комментарий
+        (в двухфазном режиме — на последний комментарий в посте).
+
+        Посты читаются параллельно, но в очередь попадают в порядке post_ids:
+        страницы первого ещё не дочитанного поста идут сразу, остальные копятся
+        в буфере до его завершения. Так пересечения разрешаются как и раньше.
+        """
+        queue: "asyncio.Queue[Tuple[int, int, int] | None]" = asyncio.Queue()
+        semaphore = asyncio.Semaphore(self.cfg.collect_concurrency)
+        enricher = UserEnricher(self)
+        seen: Set[int] = set()
+        sender = ReplySender(self, message, self.community.send_concurrency, on_progress=on_progress)
+        sender.estimated = True
+
+        if on_progress:
+            on_progress(
+                {
+                    "stage": "sending",
+                    "total": 0,
+                    "estimated": True,
+                    "log": "Потоковый режим: отвечаю по мере чтения комментариев...",
+                }
+            )
+
+        posts = list(post_ids)
+        # Страницы постов за фронтиром: (страница, кому под постом уже отвечали)
+        buffers: List[List[Tuple[List[Tuple[int, int]], Set[int]]]] = [[] for _ in posts]
+        claimed: Set[int] = set()  # уже получали ответ под первым своим постом
+        finished = [False] * len(posts)
+        counts = [0] * len(posts)
+        found = [0] * len(posts)
+        frontier = 0  # страницы этого поста уходят в очередь сразу, остальные ждут в буфере
+        released = 0  # сколько комментариев уже прошло через дедупликацию
+
+        def release(idx: int, page: List[Tuple[int, int]], replied: Set[int]) -> None:
+            nonlocal released
+            post_id = posts[idx]
+            released += len(page)
+            new_users: List[int] = []
+            for user_id, comment_id in page:
+                if not user_id or user_id <= 0 or comment_id is None:
+                    continue
+                if user_id in seen or user_id in claimed:
+                    continue
+                if user_id in replied:
+                    claimed.add(user_id)
+                    continue
+                seen.add(user_id)
+                new_users.append(user_id)
+                queue.put_nowait((user_id, post_id, comment_id))
+            found[idx] += len(new_users)
+            enricher.add(new_users)
+
+            # Оценка: доля уникальных участников среди прочитанного, умноженная на все комментарии
+            known = sum(counts)
+            if released and known > released:
+                sender.total = max(len(seen), len(seen) * known // released)
             else:
-                failed += 1
+                sender.total = len(seen)
+
+        def advance() -> None:
+            # Отдаём буферы по порядку post_ids: первый пост в списке выигрывает
+            nonlocal frontier
+            while frontier < len(posts):
+                for page, replied in buffers[frontier]:
+                    release(frontier, page, replied)
+                buffers[frontier] = []
+                if not finished[frontier]:
+                    return
+                if on_progress:
+                    on_progress(
+                        {
+                            "stage": "collect_done",
+                            "log": f"Пост {posts[frontier]}: новых участников {found[frontier]}",
+                            "unique_total": len(seen),
+                        }
+                    )
+                frontier += 1
+
+        async def collect(idx: int) -> None:
+            post_id = posts[idx]
+            async with semaphore:
+                if on_progress:
+                    on_progress({"stage": "collect", "log": f"Читаю комментарии поста {post_id}..."})
 
+                loaded = 0
+                async for count, page in self._iter_commentator_pages(post_id, on_progress=on_progress):
+                    loaded += len(page)
+                    counts[idx] = max(count, loaded)
+                    replied = await self._replied_users(post_id, page) if only_new else set()
+                    if idx == frontier:
+                        release(idx, page, replied)
+                    else:
+                        buffers[idx].append((page, replied))
+
+                    if on_progress:
+                        on_progress(
+                            {
+                                "stage": "collect",
+                                "post_id": post_id,
+                                "loaded": loaded,
+                                "unique": len(seen),
+                                "total": sender.total,
+                                "estimated": True,
+                            }
+                        )
+
+            counts[idx] = loaded
+            finished[idx] = True
+            advance()
+
+        async def produce() -> None:
+            try:
+                await _gather_or_cancel(*(collect(idx) for idx in range(len(posts))))
+            finally:
+                queue.put_nowait(None)
+
+            sender.total = len(seen)
+            sender.estimated = False
             if on_progress:
                 on_progress(
                     {
-                        "stage": "progress",
-                        "current": idx,
-                        "total": total,
-                        "sent": sent,
-                        "failed": failed,
-                        "user_id": user_id,
-                        "post_id": post_id,
-                        "comment_id": comment_id,
+                        "stage": "collect_finished",
+                        "total": sender.total,
+                        "log": f"Сбор завершён, всего участников {sender.total}",
                     }
                 )
+            enricher.flush()
 
-            await asyncio.sleep(self.cfg.request_delay)
+        async def consume() -> None:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                await sender.submit(*item)
+            await sender.drain()
 
+        producer = asyncio.create_task(produce())
+        try:
+            await consume()
+            await producer
+            await enricher.wait()
+        finally:
+            producer.cancel()
+            sender.cancel()
+            enricher.cancel()
+
+        sent, failed, total = sender.sent, sender.failed, len(seen)
+        response_cache.invalidate(self.community.group_id)
         if on_progress:
             on_progress({"stage": "completed", "sent": sent, "failed": failed, "total": total})
 
         return {"sent": sent, "failed": failed, "total": total}
+
+
+class ClientPool:
+    """
+    Долгоживущие VKService по сообществам, общие для API, задач и автоответов.
+    Клиент пересоздаётся, когда в сохранённом конфиге меняются его токены;
+    старый закрывается, как только его отпустит последний пользователь.
+    """
+
+    def __init__(self) -> None:
+        self._clients: Dict[int, VKService] = {}
+        self._leases: Dict[int, int] = {}
+        self._retired: Dict[int, VKService] = {}
+
+    def get(self, cfg: BotConfig) -> VKService:
+        community = get_active_community(cfg)
+        if not community:
+            raise RuntimeError("Не выбрано сообщество")
+
+        client = self._clients.get(community.group_id)
+        if client and _tokens(client.community) != _tokens(community):
+            self._retire(community.group_id)
+            client = None
+        if client is None:
+            client = VKService(cfg)
+            self._clients[community.group_id] = client
+        else:
+            client.cfg = cfg
+            client.community = community
+        return client
+
+    def acquire(self, cfg: BotConfig) -> VKService:
+        """Выдаёт клиента в пользование; пока он не отпущен, закрыт он не будет."""
+        client = self.get(cfg)
+        key = id(client)
+        self._leases[key] = self._leases.get(key, 0) + 1
+        return client
+
+    async def release(self, client: VKService) -> None:
+        key = id(client)
+        self._leases[key] -= 1
+        if not self._leases[key]:
+            del self._leases[key]
+            if self._retired.pop(key, None) is not None:
+                await client.close()
+
+    @asynccontextmanager
+    async def lease(self, cfg: BotConfig) -> AsyncIterator[VKService]:
+        client = self.acquire(cfg)
+        try:
+            yield client
+        finally:
+            await self.release(client)
+
+    def on_config_saved(self, cfg: BotConfig) -> None:
+        communities = {c.group_id: c for c in cfg.communities}
+        for group_id, client in list(self._clients.items()):
+            community = communities.get(group_id)
+            if community is None or _tokens(community) != _tokens(client.community):
+                self._retire(group_id)
+
+    def _retire(self, group_id: int) -> None:
+        client = self._clients.pop(group_id)
+        if self._leases.get(id(client)):
+            self._retired[id(client)] = client
+            return
+        try:
+            asyncio.get_running_loop().create_task(client.close())
+        except RuntimeError:
+            pass  # нет активного цикла событий — сессия ещё не открывалась
+
+    async def close_all(self) -> None:
+        clients = list(self._clients.values()) + list(self._retired.values())
+        self._clients.clear()
+        self._retired.clear()
+        for client in clients:
+            await client.close()
+
+
+def _tokens(community: Community) -> Tuple[str, str]:
+    return (community.user_token, community.group_token)
+
+
+clients = ClientPool()
+on_config_saved(clients.on_config_saved)
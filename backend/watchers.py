@@ -1,11 +1,46 @@
 import asyncio
+import json
+import time
 import uuid
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Dict, List
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 
-from storage import BotConfig
-from vk_service import VKService
+from cache import response_cache
+from database import db_read, db_write_nowait, get_running_watchers, save_watchers
+from longpoll import RESYNC, longpoll
+from ratelimit import TokenBucket
+from storage import BotConfig, _model_copy, get_active_community, on_config_saved
+from vk_service import EXECUTE_MAX_CALLS, VKService, clients
+
+# Как часто ожидание событий Long Poll прерывается, чтобы проверить остановку
+LONGPOLL_IDLE_CHECK = 2.0
+# Сколько свежих комментариев каждого поста читается за один опрос
+POLL_COMMENTS = 30
+# Предел догоняющего чтения за один опрос: 8 execute по 25 страниц — 20 000 комментариев
+MAX_CATCH_UP_CALLS = 8
+
+# Интервалы опроса поста: активные опрашиваются раз в 1–2 с, у затихших
+# интервал удваивается после каждого пустого опроса до MAX_POLL_INTERVAL
+MIN_POLL_INTERVAL = 1.0
+BASE_POLL_INTERVAL = 2.0
+MAX_POLL_INTERVAL = 30.0
+POLL_BACKOFF = 2.0
+# Вес нового замера в скользящей средней частоты комментариев
+RATE_EWMA_ALPHA = 0.3
+# Сколько запросов в секунду автоответы всех сообществ могут тратить с одного
+# пользовательского токена; остальной лимит остаётся рассылкам и интерфейсу
+WATCH_BUDGET_RPS = 1.0
+
+# Сколько найденных, но ещё не отвеченных комментариев может ждать в очереди
+# сообщества; при переполнении обнаружение ждёт, пока ответы разгребут очередь
+REPLY_QUEUE_SIZE = 1000
+
+# Как часто курсоры автоответов сохраняются в базу (пачкой на сообщество)
+CHECKPOINT_INTERVAL = 5.0
+
+# Пробуждает цикл сообщества, когда добавили или остановили автоответ
+WAKE: Dict[str, Any] = {"wake": True}
 
 
 @dataclass
@@ -13,11 +48,23 @@ class WatchState:
     id: str
     post_id: int
     message: str
+    group_id: int = 0
     status: str = "running"
     created_at: str = field(default_factory=lambda: datetime.utcnow().isoformat())
     replied: int = 0
     errors: int = 0
     last_seen_comment: int = 0
+    source: str = "polling"  # longpoll | polling
+    primed: bool = False  # старые комментарии уже пропущены
+    # После перезапуска: комментарии за время простоя надо дочитать опросом,
+    # даже если дальше комментарии приходят через Long Poll
+    catch_up: bool = False
+    poll_interval: float = BASE_POLL_INTERVAL
+    comment_rate: float = 0.0  # комментариев в секунду, скользящая средняя
+    last_polled_at: float = 0.0
+    next_poll_at: float = 0.0
+    # Комментарии в очереди на ответ: id -> когда поставлен (time.monotonic)
+    pending: Dict[int, float] = field(default_factory=dict)
     log: List[str] = field(default_factory=list)
 
     def add_log(self, text: str) -> None:
@@ -35,77 +82,461 @@ class WatchState:
             "replied": self.replied,
             "errors": self.errors,
             "last_seen_comment": self.last_seen_comment,
+            "source": self.source,
+            "poll_interval": round(self.poll_interval, 1),
+            "comments_per_minute": round(self.comment_rate * 60, 2),
+            "queue_depth": len(self.pending),
+            "queue_age": round(time.monotonic() - min(self.pending.values()), 1) if self.pending else 0.0,
             "log": self.log,
         }
 
+    def record(self) -> Dict[str, Any]:
+        """Строка для таблицы watchers."""
+        return {
+            "id": self.id,
+            "group_id": self.group_id,
+            "post_id": self.post_id,
+            "message": self.message,
+            "status": self.status,
+            "created_at": self.created_at,
+            "replied": self.replied,
+            "errors": self.errors,
+            "last_seen_comment": self.resume_cursor(),
+            "log": list(self.log),
+        }
+
+    def resume_cursor(self) -> int:
+        """
+        Курсор для базы: до самого старого комментария, ответ на который ещё в
+        очереди, чтобы после перезапуска он не потерялся.
+        """
+        if self.pending:
+            return min(self.pending) - 1
+        return self.last_seen_comment
+
+    def cursor(self) -> Tuple[int, int, int]:
+        return (self.resume_cursor(), self.replied, self.errors)
+
+    def observe(self, new_comments: int, now: float) -> None:
+        """Обновляет частоту комментариев и следующий интервал опроса после чтения поста."""
+        if self.last_polled_at:
+            elapsed = max(now - self.last_polled_at, 1e-3)
+            self.comment_rate += RATE_EWMA_ALPHA * (new_comments / elapsed - self.comment_rate)
+        if new_comments:
+            # Ждём примерно один новый комментарий на опрос, но не реже базового интервала
+            expected = 1 / self.comment_rate if self.comment_rate else BASE_POLL_INTERVAL
+            self.poll_interval = max(MIN_POLL_INTERVAL, min(BASE_POLL_INTERVAL, expected))
+        else:
+            self.poll_interval = min(MAX_POLL_INTERVAL, self.poll_interval * POLL_BACKOFF)
+        self.last_polled_at = now
+        self.next_poll_at = now + self.poll_interval
+
+
+_budgets: Dict[str, TokenBucket] = {}
+
+
+def get_watch_budget(token: str) -> TokenBucket:
+    """Общий для автоответов бюджет запросов токена (поверх общего лимитера VK)."""
+    budget = _budgets.get(token)
+    if budget is None:
+        budget = TokenBucket(WATCH_BUDGET_RPS)
+        _budgets[token] = budget
+    return budget
+
+
+class CommunityWatcher:
+    """
+    Один цикл на сообщество для всех его автоответов: посты читаются вместе
+    (один execute на 25 постов за тик), новые комментарии раздаются по WatchState.
+    """
+
+    def __init__(self, manager: "WatchManager", group_id: int, cfg: BotConfig) -> None:
+        self.manager = manager
+        self.group_id = group_id
+        self.cfg = cfg
+        self.states: Dict[str, WatchState] = {}
+        self.events: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+        self.replies: "asyncio.Queue[Tuple[WatchState, int]]" = asyncio.Queue(REPLY_QUEUE_SIZE)
+        self.client: Optional[VKService] = None
+        self._task: Optional["asyncio.Task[None]"] = None
+        self._saved: Dict[str, Tuple[int, int, int]] = {}
+        self._checkpoint_at = time.monotonic() + CHECKPOINT_INTERVAL
+
+    def add(self, state: WatchState, cfg: BotConfig) -> None:
+        self.cfg = cfg
+        self.states[state.id] = state
+        self.wake()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def wake(self) -> None:
+        self.events.put_nowait(WAKE)
+
+    def checkpoint(self, force: bool = False) -> None:
+        """
+        Сохраняет изменившиеся курсоры одной пачкой не чаще раза в
+        CHECKPOINT_INTERVAL: после перезапуска ответы начнутся с сохранённого места.
+        """
+        now = time.monotonic()
+        if not force and now < self._checkpoint_at:
+            return
+        self._checkpoint_at = now + CHECKPOINT_INTERVAL
+        changed = [s for s in self.states.values() if self._saved.get(s.id) != s.cursor()]
+        if not changed:
+            return
+        db_write_nowait(save_watchers, [s.record() for s in changed])
+        for state in changed:
+            self._saved[state.id] = state.cursor()
+
+    def _running(self) -> List[WatchState]:
+        stopped = []
+        for watch_id, state in list(self.states.items()):
+            if state.status != "running":
+                del self.states[watch_id]
+                self._saved.pop(watch_id, None)
+                state.add_log("Автоответ остановлен.")
+                stopped.append(state.record())
+        if stopped:
+            db_write_nowait(save_watchers, stopped)
+        return list(self.states.values())
+
+    async def _run(self) -> None:
+        client = self.client = clients.acquire(self.cfg)
+        source = longpoll.get(client)
+        subscribed: Set[int] = set()
+        # Ответы идут отдельными воркерами: чтение не ждёт, пока уйдут ответы
+        workers = [
+            asyncio.create_task(self._reply_worker())
+            for _ in range(client.community.send_concurrency)
+        ]
+        try:
+            while True:
+                self.checkpoint()
+                running = self._running()
+                if not running:
+                    break
+                # Токены сменились в настройках — старый клиент выведен из пула
+                if clients.get(self.cfg) is not client:
+                    for post_id in subscribed:
+                        source.unsubscribe(post_id, self.events)
+                    subscribed = set()
+                    previous, client = client, clients.acquire(self.cfg)
+                    self.client = client
+                    source = longpoll.get(client)
+                    await clients.release(previous)
+                    for state in running:
+                        state.catch_up = state.primed
+                        state.add_log("Токены сообщества изменены, переподключаюсь.")
+                # Подписываемся до первичного чтения, чтобы не потерять события между ними
+                posts = {s.post_id for s in running}
+                for post_id in posts - subscribed:
+                    source.subscribe(post_id, self.events)
+                for post_id in subscribed - posts:
+                    source.unsubscribe(post_id, self.events)
+                subscribed = posts
+
+                if source.active:
+                    self._switch_source(running, "longpoll", "Получаю комментарии через Long Poll.")
+                    fresh = [s for s in running if not s.primed or s.catch_up]
+                    if fresh:
+                        await self._poll(client, fresh)
+                    try:
+                        event = await asyncio.wait_for(self.events.get(), timeout=LONGPOLL_IDLE_CHECK)
+                    except asyncio.TimeoutError:
+                        continue
+                    batch = [event] + self._drain()
+                    if not any(e is RESYNC for e in batch):
+                        await self._dispatch(client, batch)
+                        continue
+                    # События потеряны или Long Poll отвалился — перечитываем комментарии
+                    await self._poll(client, self._running())
+                    continue
+
+                self._switch_source(
+                    running, "polling", source.error or "Перечитываю комментарии опросом."
+                )
+                self._drain()  # опрос и так прочитает всё, включая новые автоответы
+                now = time.monotonic()
+                due = {s.post_id for s in running if s.next_poll_at <= now}
+                await self._poll(client, [s for s in running if s.post_id in due])
+                running = self._running()
+                if running:
+                    next_at = min(s.next_poll_at for s in running)
+                    await self._idle(max(0.0, next_at - time.monotonic()))
+        finally:
+            # Снимаемся с учёта до первого await: новый start создаст свежий цикл
+            self.manager.communities.pop(self.group_id, None)
+            for post_id in subscribed:
+                source.unsubscribe(post_id, self.events)
+            for worker in workers:
+                worker.cancel()
+            # Оставшиеся автоответы прерваны, а не остановлены пользователем:
+            # в базе они остаются running и продолжатся после перезапуска
+            self.checkpoint(force=True)
+            for state in self.states.values():
+                state.status = "stopped"
+                state.add_log("Автоответ остановлен.")
+            self.states.clear()
+            await clients.release(client)
+
+    def _drain(self) -> List[Dict[str, Any]]:
+        batch = []
+        while not self.events.empty():
+            batch.append(self.events.get_nowait())
+        return batch
+
+    async def _idle(self, delay: float) -> None:
+        """Пауза между опросами, которую прерывает добавление или остановка автоответа."""
+        try:
+            await asyncio.wait_for(self.events.get(), timeout=delay)
+        except asyncio.TimeoutError:
+            return
+        self._drain()
+
+    @staticmethod
+    def _switch_source(states: List[WatchState], source: str, message: str) -> None:
+        for state in states:
+            if state.source != source:
+                state.source = source
+                state.add_log(message)
+
+    async def _dispatch(self, client: VKService, batch: List[Dict[str, Any]]) -> None:
+        by_post: Dict[int, List[int]] = {}
+        for event in batch:
+            if event is WAKE or not event.get("id"):
+                continue
+            by_post.setdefault(int(event.get("post_id") or 0), []).append(int(event["id"]))
+        for state in self._running():
+            # До первичного чтения события не нужны: оно само выставит last_seen_comment
+            if state.primed and state.post_id in by_post:
+                found = await self._enqueue_new(state, by_post[state.post_id])
+                state.observe(found, time.monotonic())
+
+    async def _poll(self, client: VKService, states: List[WatchState]) -> bool:
+        """
+        Читает свежие комментарии постов пачками по 25 (один execute на пачку,
+        в пределах бюджета токена) и ставит новые в очередь ответов. Самые просроченные посты
+        читаются первыми.
+        """
+        if not states:
+            return False
+        budget = get_watch_budget(client.community.user_token)
+        order: Dict[int, float] = {}
+        for state in states:
+            order[state.post_id] = min(order.get(state.post_id, state.next_poll_at), state.next_poll_at)
+        post_ids = sorted(order, key=lambda post_id: order[post_id])
+
+        new_processed = False
+        for i in range(0, len(post_ids), EXECUTE_MAX_CALLS):
+            chunk = post_ids[i:i + EXECUTE_MAX_CALLS]
+            chunk_states = [s for s in states if s.post_id in chunk]
+            await budget.acquire()
+            try:
+                latest = await client.fetch_latest_comment_ids(chunk, limit=POLL_COMMENTS)
+            except Exception as exc:
+                now = time.monotonic()
+                for state in chunk_states:
+                    state.errors += 1
+                    state.add_log(f"Ошибка чтения: {exc}")
+                    state.next_poll_at = now + state.poll_interval
+                await asyncio.sleep(self.cfg.request_delay or 0.5)
+                continue
+
+            failed: Dict[int, str] = {}
+            for post_id in chunk:
+                ids = latest.get(post_id)
+                primed = [s.last_seen_comment for s in chunk_states if s.post_id == post_id and s.primed]
+                # Курсор 0 — пост был без комментариев при старте: дочитываем всё
+                since = min(primed, default=0)
+                # Страница заполнена целиком и вся новее last_seen_comment — за
+                # время между опросами пришло больше, дочитываем остальное
+                if ids and primed and len(ids) >= POLL_COMMENTS and min(ids) > since:
+                    try:
+                        extra, complete = await self._catch_up(
+                            client, budget, post_id, since, offset=len(ids)
+                        )
+                    except Exception as exc:
+                        failed[post_id] = f"Ошибка чтения: {exc}"
+                        continue
+                    latest[post_id] = ids + extra
+                    for state in chunk_states:
+                        if state.post_id == post_id:
+                            state.add_log(f"Всплеск комментариев: дочитал ещё {len(extra)}.")
+                            if not complete:
+                                state.add_log("Всплеск слишком большой, самые старые комментарии пропущены.")
+
+            now = time.monotonic()
+            for state in chunk_states:
+                if state.status != "running":
+                    continue
+                ids = latest.get(state.post_id)
+                if ids is None or state.post_id in failed:
+                    # last_seen_comment не двигаем: на следующем опросе дочитаем заново
+                    state.errors += 1
+                    state.add_log(failed.get(state.post_id, "Ошибка чтения: пост недоступен."))
+                    state.observe(0, now)
+                    continue
+                if not state.primed:
+                    # первичное считывание, чтобы не отвечать на старые
+                    state.primed = True
+                    state.last_polled_at = now
+                    state.next_poll_at = now + state.poll_interval
+                    if ids:
+                        state.last_seen_comment = max(ids)
+                        state.add_log(f"Пропустил {len(ids)} старых комментариев.")
+                    continue
+                state.catch_up = False
+                found = await self._enqueue_new(state, ids)
+                state.observe(found, now)
+                if found:
+                    new_processed = True
+        return new_processed
+
+    async def _catch_up(
+        self, client: VKService, budget: TokenBucket, post_id: int, since_id: int, offset: int
+    ) -> Tuple[List[int], bool]:
+        """
+        Дочитывает всплеск комментариев новее since_id пачками по 25 страниц.
+        Второе значение — дошли ли до since_id за MAX_CATCH_UP_CALLS вызовов.
+        """
+        ids: List[int] = []
+        next_offset: Optional[int] = offset
+        for _ in range(MAX_CATCH_UP_CALLS):
+            await budget.acquire()
+            page_ids, next_offset = await client.fetch_comment_ids_since(post_id, since_id, next_offset)
+            ids.extend(page_ids)
+            if next_offset is None:
+                return ids, True
+        return ids, False
+
+    async def _enqueue_new(self, state: WatchState, comment_ids: Iterable[int]) -> int:
+        """Ставит в очередь ответов комментарии новее last_seen_comment, от старых к новым."""
+        found = 0
+        now = time.monotonic()
+        for cid in sorted(set(comment_ids)):
+            if state.last_seen_comment and cid <= state.last_seen_comment:
+                continue
+            state.last_seen_comment = cid
+            state.pending[cid] = now
+            await self.replies.put((state, cid))
+            found += 1
+        return found
+
+    async def _reply_worker(self) -> None:
+        """Отвечает на комментарии из очереди; скорость держит лимитер группового токена."""
+        while True:
+            state, cid = await self.replies.get()
+            try:
+                if state.status != "running":
+                    continue
+                client = self.client  # после смены токенов — уже новый клиент
+                ok = await client.reply_to_comment(state.post_id, cid, state.message)
+                if ok:
+                    state.replied += 1
+                    state.add_log(f"Ответил на комментарий {cid}")
+                else:
+                    state.errors += 1
+                    state.add_log(f"Не удалось ответить на {cid}")
+                response_cache.invalidate(client.community.group_id, post_id=state.post_id)
+            finally:
+                state.pending.pop(cid, None)
+                self.replies.task_done()
+
 
 class WatchManager:
     def __init__(self) -> None:
         self.watchers: Dict[str, WatchState] = {}
+        self.communities: Dict[int, CommunityWatcher] = {}
 
     def list(self) -> List[Dict[str, object]]:
         return [w.snapshot() for w in self.watchers.values()]
 
     def start(self, cfg: BotConfig, post_id: int, message: str) -> WatchState:
+        community = get_active_community(cfg)
+        if not community:
+            raise RuntimeError("Не выбрано сообщество")
         watch_id = uuid.uuid4().hex[:8]
-        state = WatchState(id=watch_id, post_id=post_id, message=message)
-        self.watchers[watch_id] = state
-        asyncio.create_task(self._run(state, cfg))
+        state = WatchState(id=watch_id, post_id=post_id, message=message, group_id=community.group_id)
+        state.add_log("Старт автоответа, считываю последние комментарии...")
+        db_write_nowait(save_watchers, [state.record()])
+        self._attach(cfg, state)
         return state
 
+    async def resume(self, cfg: BotConfig) -> int:
+        """
+        Поднимает автоответы, работавшие до перезапуска. Курсор берётся из базы,
+        поэтому комментарии, пришедшие за время простоя, дочитываются и получают
+        ответы (в пределах лимитов токенов), а не пропускаются как старые.
+        """
+        communities = {c.group_id for c in cfg.communities}
+        orphaned = []
+        resumed = 0
+        for row in await db_read(get_running_watchers):
+            if row["id"] in self.watchers:
+                continue
+            state = WatchState(
+                id=row["id"],
+                post_id=row["post_id"],
+                message=row["message"],
+                group_id=row["group_id"],
+                created_at=row["created_at"],
+                replied=row["replied"] or 0,
+                errors=row["errors"] or 0,
+                last_seen_comment=row["last_seen_comment"] or 0,
+                log=json.loads(row["log"] or "[]"),
+            )
+            if state.group_id not in communities:
+                state.status = "stopped"
+                state.add_log("Сообщество удалено из настроек, автоответ остановлен.")
+                orphaned.append(state.record())
+                continue
+            state.primed = bool(state.last_seen_comment)
+            state.catch_up = state.primed
+            state.add_log(f"Продолжаю после перезапуска с комментария {state.last_seen_comment}.")
+            self._attach(_model_copy(cfg, {"active_group_id": state.group_id}), state)
+            resumed += 1
+        if orphaned:
+            db_write_nowait(save_watchers, orphaned)
+        return resumed
+
+    def checkpoint(self) -> None:
+        """Сохраняет курсоры всех автоответов сразу (при остановке приложения)."""
+        for watcher in list(self.communities.values()):
+            watcher.checkpoint(force=True)
+
+    def on_config_saved(self, cfg: BotConfig) -> None:
+        """Передаёт циклам свежие настройки: при смене токенов они сменят клиента."""
+        communities = {c.group_id for c in cfg.communities}
+        for group_id, watcher in list(self.communities.items()):
+            if group_id in communities:
+                watcher.cfg = _model_copy(cfg, {"active_group_id": group_id})
+                watcher.wake()
+                continue
+            for state in watcher.states.values():
+                if state.status == "running":
+                    state.status = "stopped"
+                    state.add_log("Сообщество удалено из настроек, автоответ остановлен.")
+            watcher.wake()
+
+    def _attach(self, cfg: BotConfig, state: WatchState) -> None:
+        self.watchers[state.id] = state
+        watcher = self.communities.get(state.group_id)
+        if watcher is None:
+            watcher = CommunityWatcher(self, state.group_id, cfg)
+            self.communities[state.group_id] = watcher
+        watcher.add(state, cfg)
+
     def stop(self, watch_id: str) -> bool:
         state = self.watchers.get(watch_id)
         if not state:
             return False
         state.status = "stopped"
         state.add_log("Остановка по запросу пользователя.")
+        for watcher in self.communities.values():
+            if watch_id in watcher.states:
+                watcher.wake()
         return True
 
-    async def _run(self, state: WatchState, cfg: BotConfig) -> None:
-        client = VKService(cfg)
-        state.add_log("Старт автоответа, считываю последние комментарии...")
-
-        # первичное считывание, чтобы не отвечать на старые
-        try:
-            comments = await client.fetch_comments(state.post_id, limit=50)
-            if comments:
-                state.last_seen_comment = max(c["id"] for c in comments)
-                state.add_log(f"Пропустил {len(comments)} старых комментариев.")
-        except Exception as exc:
-            state.add_log(f"Ошибка при начальном чтении: {exc}")
-
-        try:
-            while state.status == "running":
-                try:
-                    comments = await client.fetch_comments(state.post_id, limit=30)
-                except Exception as exc:
-                    state.errors += 1
-                    state.add_log(f"Ошибка чтения: {exc}")
-                    await asyncio.sleep(cfg.request_delay or 0.5)
-                    continue
-
-                new_processed = False
-                for c in comments or []:
-                    cid = c["id"]
-                    if state.last_seen_comment and cid <= state.last_seen_comment:
-                        continue
-                    state.last_seen_comment = max(state.last_seen_comment, cid)
-                    ok = await client.reply_to_comment(state.post_id, cid, state.message)
-                    if ok:
-                        state.replied += 1
-                        state.add_log(f"Ответил на комментарий {cid}")
-                    else:
-                        state.errors += 1
-                        state.add_log(f"Не удалось ответить на {cid}")
-                    new_processed = True
-                    await asyncio.sleep(cfg.request_delay or 0.35)
-
-                # более частый опрос, чтобы отвечать почти сразу
-                await asyncio.sleep(1 if new_processed else 2)
-        finally:
-            state.status = "stopped"
-            state.add_log("Автоответ остановлен.")
-            await client.close()
-
 
 watchers = WatchManager()
+on_config_saved(watchers.on_config_saved)
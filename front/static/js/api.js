@@ -7,6 +7,7 @@ export async function loadPosts() {
         const res = await fetch("/api/posts?limit=100");
         if (!res.ok) throw new Error(await res.text());
         const data = await res.json();
+        state.postsCursor = data.next_cursor || null;
         return data.items || [];
     } catch (err) {
         els.postsList.innerHTML = `<div class="empty">Не удалось загрузить посты: ${err}</div>`;
@@ -15,12 +16,38 @@ export async function loadPosts() {
     }
 }
 
-export async function startSend(postIds, message) {
+export async function loadMorePosts() {
+    if (!state.postsCursor) return [];
+    try {
+        const res = await fetch(`/api/posts?limit=100&cursor=${encodeURIComponent(state.postsCursor)}`);
+        if (!res.ok) throw new Error(await res.text());
+        const data = await res.json();
+        state.postsCursor = data.next_cursor || null;
+        return data.items || [];
+    } catch (err) {
+        toast("Не удалось загрузить следующие посты", true);
+        return [];
+    }
+}
+
+export async function loadNewPosts(sinceId) {
+    try {
+        const res = await fetch(`/api/posts?since_id=${Number(sinceId)}`);
+        if (!res.ok) throw new Error(await res.text());
+        const data = await res.json();
+        return data.items || [];
+    } catch (err) {
+        toast("Ошибка обновления постов", true);
+        return [];
+    }
+}
+
+export async function startSend(postIds, message, onlyNew = false) {
     try {
         const res = await fetch("/api/send", {
             method: "POST",
             headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({ post_ids: postIds, message }),
+            body: JSON.stringify({ post_ids: postIds, message, only_new: onlyNew }),
         });
         if (!res.ok) throw new Error(await res.text());
         const data = await res.json();
@@ -12,6 +12,8 @@ import {
 } from "./ui.js";
 import {
     loadPosts,
+    loadMorePosts,
+    loadNewPosts,
     startSend,
     fetchTask,
     fetchTasks,
@@ -22,12 +24,43 @@ import {
     stopWatch,
 } from "./api.js";
 
+function updateMorePostsButton() {
+    if (els.btnMorePosts) els.btnMorePosts.hidden = !state.postsCursor;
+}
+
 async function handleLoadPosts() {
     const items = await loadPosts();
     if (items.length > 0) {
         renderPosts(items);
         toast("Посты обновлены");
     }
+    updateMorePostsButton();
+}
+
+async function handleLoadMorePosts() {
+    const items = await loadMorePosts();
+    if (items.length > 0) {
+        const known = new Set(state.posts.map((p) => Number(p.id)));
+        renderPosts([...state.posts, ...items.filter((p) => !known.has(Number(p.id)))]);
+    }
+    updateMorePostsButton();
+}
+
+async function handleRefreshPosts() {
+    if (!state.posts.length) {
+        await handleLoadPosts();
+        return;
+    }
+    // Догружаем только посты новее уже показанных
+    const sinceId = Math.max(...state.posts.map((p) => Number(p.id)));
+    const items = await loadNewPosts(sinceId);
+    if (items.length > 0) {
+        const fresh = new Set(items.map((p) => Number(p.id)));
+        renderPosts([...items, ...state.posts.filter((p) => !fresh.has(Number(p.id)))]);
+        toast(`Новых постов: ${items.length}`);
+    } else {
+        toast("Новых постов нет");
+    }
 }
 
 async function handleStartSend() {
@@ -43,7 +76,7 @@ async function handleStartSend() {
         return;
     }
     try {
-        const data = await startSend(postIds, message);
+        const data = await startSend(postIds, message, Boolean(els.sendOnlyNew?.checked));
         state.currentTaskId = data.task_id;
         toast("Задача запущена");
         pollTask(data.task_id);
@@ -100,6 +133,7 @@ async function handleChangeCommunity(groupId) {
             renderPosts(items);
             toast("Сообщество переключено");
         }
+        updateMorePostsButton();
     } catch (err) {
         toast("Не удалось переключить сообщество", true);
     }
@@ -169,7 +203,11 @@ function bindEvents() {
     });
     els.btnRefreshPosts?.addEventListener("click", (e) => {
         e.preventDefault();
-        handleLoadPosts();
+        handleRefreshPosts();
+    });
+    els.btnMorePosts?.addEventListener("click", (e) => {
+        e.preventDefault();
+        handleLoadMorePosts();
     });
     els.btnOpenSend?.addEventListener("click", (e) => {
         e.preventDefault();
@@ -1,6 +1,7 @@
 export const state = {
     config: window.__CONFIG__ || {},
     posts: [],
+    postsCursor: null,
     selected: new Set((window.__CONFIG__ && window.__CONFIG__.post_ids) || []),
     currentTaskId: null,
     pollHandle: null,
@@ -15,7 +16,9 @@ export const els = {
     selectedPosts: document.getElementById("selected-posts"),
     sendForm: document.getElementById("send-form"),
     sendMessage: document.getElementById("send_message"),
+    sendOnlyNew: document.getElementById("send_only_new"),
     btnLoadPosts: document.getElementById("btn-load-posts"),
+    btnMorePosts: document.getElementById("btn-more-posts"),
     btnStartSend: document.getElementById("btn-start-send"),
     btnStartWatch: document.getElementById("btn-start-watch"),
     btnRefreshTasks: document.getElementById("btn-refresh-tasks"),
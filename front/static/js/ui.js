@@ -125,12 +125,13 @@ export function updateLog(logLines) {
 
 export function updateTaskUI(task) {
     if (!task) return;
-    const { sent = 0, failed = 0, total = 0, status, log } = task;
+    const { sent = 0, failed = 0, total = 0, status, log, stages, total_estimated } = task;
     const progress = total ? Math.min(100, Math.round(((sent + failed) / total) * 100)) : 0;
+    const streaming = stages && stages.collect === "running" && stages.send === "running";
 
     els.progressBar.style.width = `${progress}%`;
-    els.progressStatus.textContent = status || "Ожидание";
-    els.progressCounter.textContent = `${sent + failed} / ${total}`;
+    els.progressStatus.textContent = streaming ? "collecting + sending" : status || "Ожидание";
+    els.progressCounter.textContent = `${sent + failed} / ${total_estimated ? "~" : ""}${total}`;
     els.counterSent.textContent = sent;
     els.counterFailed.textContent = failed;
     els.counterTotal.textContent = total;
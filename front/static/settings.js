@@ -66,6 +66,10 @@ function renderCommunities() {
                 <span>GROUP_TOKEN</span>
                 <textarea class="input-group-token" rows="2" placeholder="Токен группы">${c.group_token || ""}</textarea>
             </label>
+            <label>
+                <span>Параллельных ответов</span>
+                <input type="number" class="input-send-concurrency" min="1" max="20" value="${c.send_concurrency || 5}">
+            </label>
         `;
 
         item.querySelector(".btn-remove").addEventListener("click", () => {
@@ -87,6 +91,7 @@ function addCommunity() {
         group_id: "",
         user_token: "",
         group_token: "",
+        send_concurrency: 5,
     });
     renderCommunities();
 }
@@ -98,6 +103,7 @@ function collectCommunities() {
         const groupId = Number(item.querySelector(".input-group")?.value);
         const userToken = item.querySelector(".input-user-token")?.value.trim() || "";
         const groupToken = item.querySelector(".input-group-token")?.value.trim() || "";
+        const sendConcurrency = Number(item.querySelector(".input-send-concurrency")?.value) || 5;
         const radio = item.querySelector("input[name='activeGroup']");
         if (radio?.checked) {
             state.activeGroupId = groupId;
@@ -107,6 +113,7 @@ function collectCommunities() {
             group_id: groupId,
             user_token: userToken,
             group_token: groupToken,
+            send_concurrency: sendConcurrency,
         };
     });
 }